@@ -0,0 +1,121 @@
+'''Just enough of the Telegram Bot API to let the bot run against localhost'''
+
+import json
+import math
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from stub_server import StubHandler
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeBotAPIHandler(StubHandler):
+    '''Handles POST /bot<token>/<method> and answers like Telegram would'''
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(raw or '{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(raw).items()}
+
+        time.sleep(self.server.latency / 2)  # Half the round trip on the way in, half on the way out
+        try:
+            result = self.server.api.call(method, params)
+        except Flooded as e:
+            time.sleep(self.server.latency / 2)
+            return self.reply(429, json.dumps({'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {e.retry_after}',
+                                               'parameters': {'retry_after': e.retry_after}}).encode(), 'application/json')
+        time.sleep(self.server.latency / 2)
+        self.reply(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+
+class Flooded(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+
+
+class FakeBotAPI:
+    '''State behind the fake endpoint. Counts every call so the replay driver can report them.
+    Updates handed to push() are served to getUpdates long polls, and the time each sent message arrived is kept by its text.
+    With a `flood_limit`, a chat that gets more than that many sends, edits and deletes in a minute is answered 429 like Telegram does'''
+
+    def __init__(self, flood_limit: int = 0):
+        self.lock = threading.Lock()
+        self.new_update = threading.Condition(self.lock)
+        self.updates = []
+        self.sent_at = {}  # text -> perf_counter() when sendMessage with that text came in
+        self.calls = Counter()
+        self.next_message_id = defaultdict(lambda: 1_000_000)  # Per chat, well clear of the ids replay.py uses for incoming messages
+        self.flood_limit = flood_limit
+        self.recent = defaultdict(deque)  # chat id -> times of its last flood_limit sends
+        self.flooded = 0
+
+    def push(self, update: dict) -> None:
+        with self.lock:
+            self.updates.append(update)
+            self.new_update.notify_all()
+
+    def get_updates(self, offset: int, timeout: float) -> list[dict]:
+        '''Long poll. Called with the lock held'''
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]  # Lower offsets are confirmed
+        self.new_update.wait_for(lambda: self.updates, timeout)
+        return list(self.updates)
+
+    def call(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] += 1
+            chat_id = int(params.get('chat_id', 0))
+            if method == 'getMe':
+                return BOT_USER
+            if method == 'getUpdates':
+                return self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+            if self.flood_limit and method in ('sendMessage', 'editMessageText', 'deleteMessage'):
+                self.flood_check(chat_id)
+            if method == 'sendMessage':
+                self.sent_at[params.get('text', '')] = time.perf_counter()
+            if method in ('sendMessage', 'sendDocument'):
+                self.next_message_id[chat_id] += 1
+                return self.message(chat_id, self.next_message_id[chat_id], params.get('text', ''))
+            if method == 'editMessageText':
+                return self.message(chat_id, int(params['message_id']), params.get('text', ''))
+            return True  # sendChatAction, deleteMessage, setMyCommands and friends
+
+    def flood_check(self, chat_id: int) -> None:
+        now = time.monotonic()
+        recent = self.recent[chat_id]
+        while recent and recent[0] < now - 60:
+            recent.popleft()
+        if len(recent) >= self.flood_limit:
+            self.flooded += 1
+            raise Flooded(math.ceil(recent[0] + 60 - now))
+        recent.append(now)
+
+    @staticmethod
+    def message(chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'bench {chat_id}'},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+
+def serve(latency: float = 0.0, flood_limit: int = 0) -> ThreadingHTTPServer:
+    '''Start the fake Bot API on a free localhost port. Point the bot at server.base_url'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.connections = 0
+    server.requests = 0
+    server.api = FakeBotAPI(flood_limit)
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}/bot'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
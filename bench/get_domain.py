@@ -0,0 +1,67 @@
+'''Measure get_domain() throughput, and how long the first call takes, against a plain tldextract.extract() per call.
+
+Run from the repo root (needs data/secrets.py to exist, the example file is fine):
+python bench/get_domain.py --calls 200000 --hosts 500
+
+The urls are drawn from --hosts distinct hosts with varying paths, roughly like a chat where the same few sites get shared over and over.
+'''
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+SUFFIXES = ('com', 'co.uk', 'org', 'com.au', 'io', 'de', 'github.io', 'news')
+TRICKY = (  # Checked for the same answer as extract() on top of the generated urls
+    'nytimes.com/a?ref=https://google.com/x', 'www.wsj.com/x?mod=http://foo.bar', 'https://user:pw@Sub.BBC.co.uk:443/x',
+    '//cdn.example.org/x', 'http://[2001:db8::1]/', 'example.com.', 'HTTPS://WWW.Example.COM', 'localhost:8000', 'a.b.github.io/x#frag://z',
+)
+
+
+def make_urls(calls: int, hosts: int) -> list[str]:
+    random.seed(1)
+    names = [f'{random.choice(("", "www.", "m.", "edition."))}site{n}.{random.choice(SUFFIXES)}' for n in range(hosts)]
+    return [f'https://{random.choice(names)}/story/{random.randrange(10**6)}?ref=feed' for _ in range(calls)]
+
+
+def first_call(statement: str) -> float:
+    '''Seconds for the first call in a fresh process with an empty tldextract cache, like a new container starting up'''
+    code = f'import time, {statement.split(".")[0]}; t1 = time.perf_counter(); {statement}("https://www.bbc.co.uk/news"); print(time.perf_counter() - t1)'
+    with tempfile.TemporaryDirectory() as cache_dir:
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=REPO, env={**os.environ, 'TLDEXTRACT_CACHE': cache_dir})
+    return float(result.stdout.split()[-1])
+
+
+def main(args: argparse.Namespace) -> None:
+    import tldextract
+    import bot
+
+    def plain(url: str) -> str:
+        result = tldextract.extract(url)
+        return f'{result.domain}.{result.suffix}'.lower() if result.domain and result.suffix else 'no domain'
+
+    urls = make_urls(args.calls, args.hosts)
+    mismatches = [url for url in (*TRICKY, *urls[:10000]) if bot.get_domain(url) != plain(url)]
+    print(f'same answer as extract(): {"yes" if not mismatches else f"no, {len(mismatches)} differ, first {mismatches[0]}"}')
+    for name, function in (('extract() per call', plain), ('get_domain()', bot.get_domain)):
+        function(urls[0])  # Load the suffix list outside the timing
+        t1 = time.perf_counter()
+        for url in urls:
+            function(url)
+        elapsed = time.perf_counter() - t1
+        print(f'{name:<20}{len(urls) / elapsed:>12,.0f} domains/sec')
+
+    print(f'first call, extract(): {first_call("tldextract.extract") * 1000:.0f}ms  get_domain(): {first_call("bot.get_domain") * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--hosts', type=int, default=500, help='distinct hosts among the urls')
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+'''Flush time and memory of PicklePersistence against SQLitePersistence at 10k and 100k chats.
+
+python bench/persistence.py [--chats 10000 100000] [--dirty 50]
+
+Each backend runs in its own process so peak RSS is comparable. "flush" is one run of what the
+Application does every update_interval: hand the persistence every chat that changed since last time.
+'''
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def chat_data(chat_id: int) -> dict:
+    '''Roughly what a busy group looks like'''
+    return {
+        'active domains': {f'news{n}.com' for n in range(random.randint(5, 40))},
+        'last url': (chat_id, f'https://news1.com/story/{chat_id}?ref=feed'),
+        'response record': {n: n + 1 for n in range(10)},
+        'response text record': {n: f'look at this https://news1.com/story/{n}' for n in range(10)},
+    }
+
+
+async def child(backend: str, chats: int, dirty: int, directory: str) -> None:
+    from telegram.ext import PicklePersistence
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    pickle_file = os.path.join(directory, 'bot.persist')
+    if backend == 'make':
+        return await make_pickle(chats, directory)
+    if backend == 'import':
+        t1 = time.perf_counter()
+        await bot.SQLitePersistence(os.path.join(directory, 'bot.sqlite')).import_pickle(pickle_file)
+        print(f'import  {chats:>7} chats  one-shot import from pickle {(time.perf_counter() - t1) * 1000:9.1f}ms')
+        return
+    if backend == 'pickle':
+        persistence = PicklePersistence(filepath=pickle_file, on_flush=False)
+    else:
+        persistence = bot.SQLitePersistence(os.path.join(directory, 'bot.sqlite'))
+
+    t1 = time.perf_counter()
+    loaded = await persistence.get_chat_data()  # What Application.initialize() does
+    load_time = time.perf_counter() - t1
+
+    changed = random.sample(range(chats), dirty)
+    for chat_id in changed:
+        data = loaded.get(chat_id) or {}
+        await persistence.refresh_chat_data(chat_id, data)  # What a handler touching the chat does
+        data['last url'] = (0, 'https://news2.com/')
+        loaded[chat_id] = data
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(persistence.update_chat_data(chat_id, loaded[chat_id]) for chat_id in changed))
+    flush_time = time.perf_counter() - t1
+    await persistence.flush()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{backend:<7} {chats:>7} chats  startup load {load_time * 1000:9.1f}ms  flush of {dirty} changed chats {flush_time * 1000:9.1f}ms  peak RSS {rss:7.1f}MB')
+
+
+async def make_pickle(chats: int, directory: str) -> None:
+    from telegram.ext import PicklePersistence
+    persistence = PicklePersistence(filepath=os.path.join(directory, 'bot.persist'), on_flush=True)
+    for chat_id in range(chats):
+        await persistence.update_chat_data(chat_id, chat_data(chat_id))
+    await persistence.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--dirty', type=int, default=50, help='chats that changed since the last flush')
+    parser.add_argument('--child', nargs=2, metavar=('BACKEND', 'DIRECTORY'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        asyncio.run(child(args.child[0], args.chats[0], args.dirty, args.child[1]))
+    else:
+        for chats in args.chats:
+            with tempfile.TemporaryDirectory() as directory:
+                for backend in ('make', 'pickle', 'import', 'sqlite'):  # Separate processes all round. Linux carries peak RSS over from the parent
+                    subprocess.run([sys.executable, __file__, '--chats', str(chats), '--dirty', str(args.dirty), '--child', backend, directory], check=True)
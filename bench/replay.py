@@ -0,0 +1,163 @@
+'''Push synthetic updates through incoming(), include() and translate() with every outside service stubbed out.
+
+Run from the repo root (needs data/secrets.py to exist, the example file is fine):
+python bench/replay.py --updates 2000 --chats 50 --latency 0.02 --failure-rate 0.02
+
+Reports updates/sec, p50/p99 time to handle an update (which includes sending the reply),
+outbound requests per host and Bot API calls per method. --flood-limit makes the fake Bot API enforce a flood limit like Telegram's.
+'''
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpcloak
+from telegram import Update
+from telegram.ext import Application, CommandHandler, MessageHandler, filters
+
+import bot
+import fake_bot_api
+import stub_server
+
+ACTIVE_DOMAINS = ('bench-paywalled.com', 'bench-news.org')  # Real TLDs, URLExtract won't see .example as a url
+OTHER_DOMAINS = ('bench-free.net', 'bench-blog.io')
+CHATTER = ('lol', 'anyone up?', 'that is wild', 'see you tomorrow', 'agreed, the second point is the important one')
+
+
+class RoutedSession(bot.CountingSession):
+    '''Sends every request to the stub server as /<host>/<path> instead of out to the internet.
+    Rerouted after scheduling, so the outbound scheduler still sees the real host'''
+    stub = ''
+
+    def route(self, url: str) -> str:
+        url_parts = urlsplit(url)
+        return f'{self.stub}/{url_parts.netloc}{url_parts.path or "/"}' + (f'?{url_parts.query}' if url_parts.query else '')
+
+    async def get_async(self, url: str, *args, **kwargs):
+        return await self.scheduled('GET', url, lambda: httpcloak.Session.get_async(self, self.route(url), *args, **kwargs))
+
+    async def request_async(self, method: str, url: str, *args, **kwargs):
+        return await self.scheduled(method, url, lambda: httpcloak.Session.request_async(self, method, self.route(url), *args, **kwargs))
+
+
+def make_update(update_id: int, chat_id: int, message_id: int, text: str) -> dict:
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'bench {chat_id}'},
+        'from': {'id': chat_id * 10, 'is_bot': False, 'first_name': 'Bench', 'username': f'user{chat_id}'},
+        'text': text,
+        'entities': [],
+    }
+    if text.startswith('/'):
+        message['entities'].append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+    else:
+        offset = 0
+        for word in text.split(' '):
+            if '://' in word:
+                message['entities'].append({'type': 'url', 'offset': offset, 'length': len(word)})
+            offset += len(word) + 1
+    return {'update_id': update_id, 'message': message}
+
+
+def synthetic_traffic(count: int, chats: int, unique_urls: int, roundup_rate: float = 0.0) -> list[dict]:
+    '''Mostly chatter, some links (half of them to included domains) and the odd /include or /translate.
+    `roundup_rate` of the link messages carry 5 links instead of one'''
+    urls = [f'https://{random.choice(ACTIVE_DOMAINS + OTHER_DOMAINS)}/story/{n}?ref=feed' for n in range(unique_urls)]
+    updates = []
+    for update_id in range(count):
+        chat_id = -1000 - random.randrange(chats)
+        roll = random.random()
+        if roll < 0.70:
+            text = random.choice(CHATTER)
+        elif roll < 0.95:
+            links = random.sample(urls, 5) if random.random() < roundup_rate else [random.choice(urls)]
+            text = f'{random.choice(CHATTER)} {" ".join(links)}'
+        elif roll < 0.98:
+            text = '/include'
+        else:
+            text = '/translate en fr'
+        updates.append(make_update(update_id, chat_id, 10 + update_id, text))
+    return updates
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.getLogger().setLevel(logging.ERROR)  # The bot logs every message, and snitch every injected failure
+    services = stub_server.serve(args.latency, stub_server.ServicesHandler, args.failure_rate, args.hit_rate)
+    api = fake_bot_api.serve(args.api_latency, args.flood_limit)
+
+    for host in ACTIVE_DOMAINS + OTHER_DOMAINS:
+        bot.dns_cache.set(host, True, 86400)  # Nothing resolves in here, pretend it all does
+
+    RoutedSession.stub = f'http://127.0.0.1:{services.server_address[1]}'
+    bot.http_session = RoutedSession(preset='chrome-latest', timeout=bot.MAX_DEADLINE)
+
+    application = Application.builder().token('1000:bench').base_url(api.base_url).request(bot.TimedRequest(connection_pool_size=256)) \
+        .concurrent_updates(bot.ChatOrderedUpdates(args.concurrency)).build()
+    application.add_handler(CommandHandler('translate', bot.translate))
+    application.add_handler(CommandHandler('include', bot.include))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), bot.incoming))
+    await application.initialize()
+
+    chat_ids = [-1000 - n for n in range(args.chats)]
+    setup = [make_update(-n, chat_id, 1, f'/include {" ".join(ACTIVE_DOMAINS)}') for n, chat_id in enumerate(chat_ids)]
+    for data in setup:
+        await application.process_update(Update.de_json(data, application.bot))
+
+    updates = [Update.de_json(data, application.bot) for data in synthetic_traffic(args.updates, args.chats, args.urls, args.roundup_rate)]
+    services.hosts.clear()
+    api.api.calls.clear()
+
+    timings = []
+
+    async def timed(update: Update) -> None:
+        t1 = time.perf_counter()
+        await application.process_update(update)
+        timings.append(time.perf_counter() - t1)
+
+    async def handle(update: Update) -> None:
+        await application.update_processor.process_update(update, timed(update))  # Same path as Application uses
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(handle(update) for update in updates))
+    elapsed = time.perf_counter() - t1
+
+    await application.shutdown()
+    bot.http_session.close()
+
+    timings.sort()
+    print(f'{len(updates)} updates in {elapsed:.2f}s: {len(updates) / elapsed:.1f} updates/sec (concurrency {args.concurrency})')
+    print(f'handle+reply latency p50 {statistics.median(timings) * 1000:.1f}ms  p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.1f}ms  max {timings[-1] * 1000:.1f}ms')
+    print(f'outbound requests: {sum(services.hosts.values())}')
+    for host, count in services.hosts.most_common():
+        print(f'  {host:<24}{count}')
+    shed = sum(total for (name, _), total in bot.metrics.counters.items() if name == 'outbound_shed_total')
+    print(f'shed by the outbound scheduler: {shed:g}')
+    counted = {name: total for (name, _), total in bot.metrics.counters.items() if name.startswith('telegram_')}
+    print(f'Bot API calls: {sum(api.api.calls.values())}  (answered 429: {api.api.flooded}, edits merged: {counted.get("telegram_coalesced_total", 0):g}, '
+          f'typing actions skipped: {counted.get("telegram_typing_skipped_total", 0):g})')
+    for method, count in api.api.calls.most_common():
+        print(f'  {method:<24}{count}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--urls', type=int, default=200, help='distinct article urls in the traffic')
+    parser.add_argument('--concurrency', type=int, default=1, help='updates handled at once, same chat still in order. The bot runs with CONCURRENT_UPDATES')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean seconds the stub services take to answer')
+    parser.add_argument('--failure-rate', type=float, default=0.02, help='fraction of stub service requests that get a 503')
+    parser.add_argument('--hit-rate', type=float, default=0.5, help='fraction of urls the archives have a snapshot of')
+    parser.add_argument('--roundup-rate', type=float, default=0.0, help='fraction of link messages that carry 5 links')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds the fake Bot API takes per call')
+    parser.add_argument('--flood-limit', type=int, default=0, help='sends per chat per minute the fake Bot API allows before answering 429. 0 for no limit')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,65 @@
+'''Per-url latency of the old way (a new httpcloak session per lookup) against one shared session.
+
+python bench/session_reuse.py [lookups] [server latency seconds]
+'''
+
+import asyncio
+import statistics
+import sys
+import time
+
+import httpcloak
+
+from stub_server import serve
+
+PROVIDERS = 6  # Roughly how many bypasses hit the network for a single url
+
+
+async def lookup(session: httpcloak.Session, base: str) -> None:
+    await asyncio.gather(*(session.get_async(f'{base}/provider/{n}') for n in range(PROVIDERS)))
+
+
+def new_session() -> httpcloak.Session:
+    return httpcloak.Session(preset='chrome-latest', timeout=2)
+
+
+async def per_lookup_session(base: str, lookups: int) -> list[float]:
+    timings = []
+    for _ in range(lookups):
+        t1 = time.perf_counter()
+        with new_session() as session:
+            await lookup(session, base)
+        timings.append(time.perf_counter() - t1)
+    return timings
+
+
+async def shared_session(base: str, lookups: int) -> list[float]:
+    timings = []
+    with new_session() as session:
+        for _ in range(lookups):
+            t1 = time.perf_counter()
+            await lookup(session, base)
+            timings.append(time.perf_counter() - t1)
+    return timings
+
+
+def report(name: str, timings: list[float], connections: int) -> None:
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1000
+    print(f'{name:<20} p50 {p50:7.2f}ms  p99 {p99:7.2f}ms  connections opened: {connections}')
+
+
+async def main(lookups: int, latency: float) -> None:
+    for name, strategy in (('session per lookup', per_lookup_session), ('shared session', shared_session)):
+        server = serve(latency)
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        timings = await strategy(base, lookups)
+        report(name, timings, server.connections)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    asyncio.run(main(lookups, latency))
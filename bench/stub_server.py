@@ -0,0 +1,91 @@
+'''Local stand-ins for the services the bot talks to, so benchmarks don't depend on the internet'''
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Answers every GET with a small html page after `server.latency` seconds'''
+    protocol_version = 'HTTP/1.1'  # Keep-alive, otherwise there is no connection to reuse
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes. Avoid the delayed ACK stall on reused connections
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        self.reply(200, b'<html><body>stub</body></html>')
+
+    def reply(self, status: int, body: bytes, content_type: str = 'text/html') -> None:
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # Client gave up waiting, like a long poll cut short at shutdown
+
+    def log_message(self, format, *args):
+        pass  # Quiet
+
+
+class ServicesHandler(StubHandler):
+    '''Imitates the bypass services and the origin sites.
+    Requests arrive as /<real host>/<real path>, see RoutedSession in replay.py.
+    Whether a url "has a snapshot" is decided by a hash of the url so repeat lookups agree with each other'''
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.server.requests += 1
+        _, host, rest = self.path.split('/', 2)
+        self.server.hosts[host] += 1
+        time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.server.failure_rate:
+            return self.reply(503, b'overloaded')
+
+        path = '/' + rest
+        query = parse_qs(urlsplit(path).query)
+        if host == 'archive.org':
+            target = query.get('url', [''])[0]
+            closest = {'closest': {'url': f'http://web.archive.org/web/2020/{target}', 'available': True}} if self.found(target) else {}
+            return self.reply(200, json.dumps({'url': target, 'archived_snapshots': closest}).encode(), 'application/json')
+        if host.startswith('archive.'):
+            target = path.removeprefix('/timemap/')
+            return self.reply(200 if self.found(target) else 404, b'<http://timemap>')
+        if host == 'ghostarchive.org':
+            target = query.get('term', [''])[0]
+            body = '<a href="/archive/AbCdE">snapshot</a>' if self.found(target) else 'No archives for that site.'
+            return self.reply(200, body.encode())
+        if host == 'megalodon.jp':
+            target = query.get('url', [''])[0]
+            body = '<a href="https://megalodon.jp/2020-0101-0000-00/x" target="_top">' if self.found(target) else 'nothing here'
+            return self.reply(200, body.encode())
+        self.reply(200, b'<html><body>' + b'article text ' * 500 + b'</body></html>')  # Origin page
+
+    def found(self, target: str) -> bool:
+        return hash(target) % 100 < self.server.hit_rate * 100
+
+
+def serve(latency: float = 0.0, handler=StubHandler, failure_rate: float = 0.0, hit_rate: float = 0.5) -> ThreadingHTTPServer:
+    '''Start a stub server on a free localhost port in a background thread'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.hit_rate = hit_rate
+    server.connections = 0
+    server.requests = 0
+    server.hosts = Counter()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
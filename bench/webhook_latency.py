@@ -0,0 +1,114 @@
+'''Compare how long an update takes to get answered when it arrives by long polling versus by webhook.
+
+Run from the repo root (needs data/secrets.py to exist, the example file is fine):
+python bench/webhook_latency.py --updates 300 --rate 20 --latency 0.05
+
+Updates arrive at random (Poisson) times at --rate per second. Each one is answered with a single sendMessage.
+--latency is the round trip between the bot and Telegram. The fake Bot API spends half of it on the way in and half on the way out,
+and webhook POSTs are sent half of it late, as if they had to travel from Telegram.
+Reports p50/p99/max from "Telegram has the update" to "Telegram has the reply" for each mode.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, MessageHandler, filters
+
+import bot
+import fake_bot_api
+
+SECRET = 'bench-secret'
+
+
+def make_update(update_id: int) -> dict:
+    chat_id = -1000 - random.randrange(50)
+    return {'update_id': update_id, 'message': {
+        'message_id': 10 + update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'bench {chat_id}'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+        'text': f'update {update_id}',
+    }}
+
+
+async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await context.bot.send_message(update.effective_chat.id, f'reply {update.update_id}')
+
+
+async def post(port: int, data: dict, delay: float) -> None:
+    '''Deliver one update the way Telegram would, `delay` seconds after it "arrived" at Telegram'''
+    await asyncio.sleep(delay)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(data).encode()
+    writer.write(f'POST /hook HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = await reader.readline()
+    assert b' 200 ' in status, status
+    writer.close()
+
+
+async def run(mode: str, args: argparse.Namespace) -> list[float]:
+    api = fake_bot_api.serve(args.latency)
+    application = Application.builder().token('1000:bench').base_url(api.base_url).request(bot.TimedRequest(connection_pool_size=256)) \
+        .concurrent_updates(bot.ChatOrderedUpdates(bot.CONCURRENT_UPDATES)).build()
+    application.add_handler(MessageHandler(filters.TEXT, answer))
+    await application.initialize()
+
+    if mode == 'webhook':
+        server = bot.WebhookServer(application, '/hook', SECRET)
+        await server.start('127.0.0.1', 0)
+        port = server.server.sockets[0].getsockname()[1]
+    else:
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+
+    arrived = {}
+    deliveries = []
+    random.seed(1)
+    for update_id in range(1, args.updates + 1):
+        await asyncio.sleep(random.expovariate(args.rate))
+        data = make_update(update_id)
+        arrived[f'reply {update_id}'] = time.perf_counter()
+        if mode == 'webhook':
+            deliveries.append(asyncio.create_task(post(port, data, args.latency / 2)))
+        else:
+            api.api.push(data)
+
+    await asyncio.gather(*deliveries)
+    while len(api.api.sent_at) < args.updates:
+        await asyncio.sleep(0.05)
+
+    if mode == 'webhook':
+        await server.drain()
+    else:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    api.shutdown()
+    return sorted(api.api.sent_at[text] - arrived[text] for text in arrived)
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.getLogger().setLevel(logging.ERROR)
+    for mode in ('polling', 'webhook'):
+        timings = await run(mode, args)
+        print(f'{mode:<8} p50 {statistics.median(timings) * 1000:6.1f}ms  p99 {timings[int(len(timings) * 0.99) - 1] * 1000:6.1f}ms  max {timings[-1] * 1000:6.1f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=20, help='updates per second')
+    parser.add_argument('--latency', type=float, default=0.05, help='round trip seconds between the bot and Telegram')
+    asyncio.run(main(parser.parse_args()))
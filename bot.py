@@ -6,41 +6,168 @@ __version__ = '2.15.1'
 
 import asyncio
 import functools
+import hashlib
+import heapq
+import hmac
 import html
+import importlib.metadata
+import itertools
+import json
 import logging
+import os
+import pickle
 import pprint
+import random
+import secrets
+import shutil
+import signal
+import sqlite3
 import sys
+import tempfile
 import time
 import traceback
-import subprocess
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextvars import ContextVar
 from io import BytesIO
+from typing import Awaitable, Callable, Hashable
 from urllib.parse import urlsplit
 from datetime import datetime, timezone, timedelta
 
 import httpcloak
-from telegram import Update
+from telegram import Message, MessageEntity, Update
 from telegram.constants import ChatAction, ParseMode
-from telegram.error import BadRequest
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackContext, MessageHandler, PicklePersistence, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, CommandHandler, ContextTypes, MessageHandler, PersistenceInput, PicklePersistence, TypeHandler, filters
 from telegram.helpers import mention_html, create_deep_linked_url
-from tldextract import extract
+from telegram.request import HTTPXRequest
+from tldextract import TLDExtract
+from tldextract.remote import lenient_netloc
 from urlextract import URLExtract
 
 from data.secrets import LIST_OF_ADMINS, TOKEN  # If it crashed here it's because you didn't create secrets.py correctly (or at all). Or you didn't pass docker run -v /full/path/to/data/:/home/botuser/data/
+try:
+    from data.secrets import METRICS_PORT  # Optional. Serve Prometheus metrics on 127.0.0.1:METRICS_PORT
+except ImportError:
+    METRICS_PORT = None
+try:
+    from data.secrets import RESPONSE_WINDOW  # Optional. How many of its responses per chat the bot remembers, so edits and /delete can find them
+except ImportError:
+    RESPONSE_WINDOW = 500
+try:
+    from data.secrets import WEBHOOK_URL  # Optional. Have Telegram push updates to this https url instead of polling for them
+except ImportError:
+    WEBHOOK_URL = None
+try:
+    from data.secrets import WEBHOOK_PORT  # Port the webhook listener binds to. Whatever terminates https for WEBHOOK_URL forwards here
+except ImportError:
+    WEBHOOK_PORT = 8080
+try:
+    from data.secrets import WORKERS  # Optional. Handle updates in this many processes, each taking its own share of the chats
+except ImportError:
+    WORKERS = 1
+try:
+    from data.secrets import WEBHOOK_SECRET  # Telegram sends this with every update so the listener can tell real ones from strangers. Random per run if unset
+except ImportError:
+    WEBHOOK_SECRET = None
 
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
+url_extractor = URLExtract()  # Built once and shared. TLD list gets refreshed in the background, see refresh_tlds()
+domain_extractor = TLDExtract(cache_dir=None, suffix_list_urls=())  # Public suffix list snapshot that ships with tldextract. Never fetches on its own, see refresh_public_suffixes()
+
+DNS_TTL = 3600  # Seconds to trust a host that resolved
+DNS_NEGATIVE_TTL = 300  # Seconds to trust a host that did not resolve
+DNS_TIMEOUT = 2
+
+LOOKUP_BUDGET = 5  # Seconds add_bypasses() waits in total. Whatever was found by then gets used
+URLS_PER_MESSAGE = 10  # Links past this many in one message are ignored
+LOOKUPS_PER_MESSAGE = 3  # How many of one message's links get looked up at the same time
+
+DEFAULT_DEADLINE = 2  # Seconds a bypass gets until it has enough history to have its own deadline
+MIN_DEADLINE = 0.5
+MAX_DEADLINE = 4
+ARCHIVE_IS_MIRRORS = ('archive.ph', 'archive.md', 'archive.li', 'archive.vn', 'archive.fo', 'archive.today')
+
+PROGRESS_INTERVAL = 1  # Minimum seconds between progressive edits in a chat
+
+OUTBOUND_LIMIT = 64  # Bypass requests in flight at once, all hosts together. Split between workers when there are any
+OUTBOUND_PER_HOST = 6  # Bypass requests in flight at once to any one host. Split between workers too, but each gets at least 1
+OUTBOUND_SHED_AFTER = 12  # Once this many requests are waiting for a host, passive lookups stop adding to the pile
+PRIORITY_COMMAND = 0  # Someone asked for this with /include. Goes first
+PRIORITY_INCOMING = 1  # Passive scan of a message. Goes second and gets shed under load
+CONCURRENT_UPDATES = 64  # Updates handled at once. Updates from the same chat still go one at a time, in order
+
+SEND_RATE = 30  # Messages, edits and deletes per second to all chats together. Telegram's flood limit. Split between workers when there are any
+SEND_BURST = 30
+PRIVATE_SEND_RATE = 1  # Per second to any one private chat
+CHAT_SEND_BURST = 3  # Sends a quiet chat can have straight away before the per chat rate kicks in
+GROUP_SEND_RATE = (20 - CHAT_SEND_BURST) / 60  # Per second to any one group. Telegram allows about 20 a minute, burst included
+SEND_RETRIES = 3  # Times a send gets retried after Telegram answers with RetryAfter
+TYPING_VALID = 5  # Seconds a typing action shows for, unless the bot sends a message first
+
+ERROR_DIGEST_INTERVAL = 900  # Seconds between summaries of repeated errors sent to the admins
+ERROR_DIGEST_LINES = 20  # Kinds of error listed per summary, most frequent first
+ERROR_FRAMES = 3  # Innermost traceback frames that go into the fingerprint of an error that never passed through this file
+ERROR_TRACE_LENGTH = 3000  # Characters of traceback sent to the admins. The end of it, where the error is. Telegram messages top out at 4096
+
+VERSION_URL = 'https://raw.githubusercontent.com/Yossi/outline-tg-bot/master/VERSION'
+METADATA_REFRESH_INTERVAL = 6 * 3600  # Seconds between background checks for a newer bot version and library updates
+
+METRICS_MAX_HOSTS = 100  # Hosts that get their own series in the outbound metrics. The rest are counted as 'other'
+SUMMARY_SERIES = 20  # Series per counter that /stats lists, biggest first. The rest are added up into one line
+
+RESPONSE_MAX_AGE = 48 * 3600  # Telegram won't let the bot delete messages older than this, so there is no point remembering them
+
+lookups_in_flight: dict[str, 'BypassLookup'] = {}  # normalized url -> running lookup, so concurrent requests for the same url share it
+next_progress_at: dict[int, float] = {}  # chat_id -> monotonic time the chat may get its next progressive edit
+http_session: httpcloak.Session | None = None  # Shared by every bypass so connections get reused. Lives from post_init to post_shutdown
+metrics_server: asyncio.Server | None = None
+background_tasks: set[asyncio.Task] = set()  # Fire and forget tasks, referenced here so they don't get garbage collected half way
+WEBHOOK_LISTEN = '0.0.0.0'
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CHANNEL_POST, Update.EDITED_CHANNEL_POST]  # All the handlers look at. Telegram remembers this across polling and webhook, so every mode sets it
+WEBHOOK_MAX_BODY = 1 << 20  # Bytes. Updates are a few KB at most
+WEBHOOK_DRAIN_TIMEOUT = 10  # Seconds to wait for requests already being received when shutting down
+worker: int | None = None  # Which worker this process is when running under a supervisor, see WORKERS
+shared_cache: 'SharedCache | None' = None  # Bypass results shared between workers. Only used when there are workers
+error_reports: dict[str, 'ErrorReport'] = {}  # Error fingerprint -> how often it happened. Kept until restart so each kind is only reported in full once
+
 
 # logging
+class ErrorReport:
+    '''One kind of exception, told apart from the others by error_fingerprint()'''
+    def __init__(self, error: BaseException):
+        self.summary = f'{type(error).__name__}: {error}'
+        self.repeats = 0  # Since the admins last heard about it
+        self.total = 1
+
+
+def error_fingerprint(error: BaseException) -> str:
+    '''Exception type plus the path it took through this file. The same bug gives the same fingerprint whatever the message says.
+    Library frames are left out, every Bot API error ends in the same few of those whichever call failed.
+    So does the send queue, which is why the whole path counts and not just the innermost frames'''
+    frames = traceback.extract_tb(error.__traceback__)
+    frames = [frame for frame in frames if frame.filename == __file__] or frames[-ERROR_FRAMES:]
+    return digest(repr((type(error).__qualname__, [(os.path.basename(frame.filename), frame.name, frame.lineno) for frame in frames]))).hex()
+
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    '''Log the error and send a telegram message to notify the developer.'''
+    '''Log the error and send a telegram message to notify the developer.
+    Only the first of each kind goes out straight away. Repeats are counted and summed up by error_digest_task()'''
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
+    metrics.count('errors_total', type=type(context.error).__name__)
 
     if not update:
+        return  # Polling network errors and job errors. Logged above, but not sent and not counted as a kind of error
+
+    fingerprint = error_fingerprint(context.error)
+    if report := error_reports.get(fingerprint):
+        report.repeats += 1
+        report.total += 1
         return
+    error_reports[fingerprint] = ErrorReport(context.error)
 
     trace = "".join(traceback.format_exception(None, context.error, context.error.__traceback__))
     user_info = ""
@@ -54,10 +181,33 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
     text = update.effective_message.text if update.effective_message else None
 
-    message = f"Hey.\n The error <code>{sys.exc_info()[0].__name__}: {html.escape(str(context.error))}</code> happened{user_info} said <code>{text}</code>.\n\n<pre><code class='language-python'>{html.escape(trace)}</code></pre>"
+    message = f"Hey.\n The error <code>{type(context.error).__name__}: {html.escape(str(context.error))}</code> happened{user_info} said <code>{text}</code>.\n\n" \
+              f"<pre><code class='language-python'>{html.escape(trace[-ERROR_TRACE_LENGTH:])}</code></pre>\n" \
+              f"Fingerprint <code>{fingerprint}</code>. Repeats get summed up every {ERROR_DIGEST_INTERVAL // 60} minutes."
+
+    await notify_admins(message, context)
 
-    for admin_id in LIST_OF_ADMINS:
-        await context.bot.send_message(chat_id=admin_id, text=message, parse_mode=ParseMode.HTML)
+
+async def notify_admins(message: str, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Send `message` to every admin at once. One admin being unreachable doesn't stop the rest'''
+    results = await asyncio.gather(*(outbox.submit(admin_id, functools.partial(context.bot.send_message, chat_id=admin_id, text=message, parse_mode=ParseMode.HTML))
+                                     for admin_id in LIST_OF_ADMINS), return_exceptions=True)
+    for admin_id, result in zip(LIST_OF_ADMINS, results):
+        if isinstance(result, Exception):
+            logging.warning(f'Could not notify admin {admin_id}: {result!r}')
+
+
+async def error_digest_task(context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Run by job_queue periodically to tell the admins how often each known error came back since the last digest'''
+    repeated = sorted(((fingerprint, report) for fingerprint, report in error_reports.items() if report.repeats), key=lambda item: -item[1].repeats)
+    if not repeated:
+        return
+    lines = [f'{report.repeats}× <code>{html.escape(report.summary[:200])}</code> ({fingerprint}, {report.total} since startup)' for fingerprint, report in repeated[:ERROR_DIGEST_LINES]]
+    if len(repeated) > ERROR_DIGEST_LINES:
+        lines.append(f'and {len(repeated) - ERROR_DIGEST_LINES} more kinds')
+    for _, report in repeated:
+        report.repeats = 0
+    await notify_admins(f'Errors that came back in the last {ERROR_DIGEST_INTERVAL // 60} minutes:\n' + '\n'.join(lines), context)
 
 
 # decorators
@@ -75,7 +225,13 @@ def log(func):
         # logging.info(f'update.message: {bool(update.message)}')
         # logging.info(f'update.edited_message: {bool(update.edited_message)}')
 
-        return await func(update, context, *args, **kwargs)
+        sent_at = update.effective_message.edit_date or update.effective_message.date
+        metrics.observe('update_lag_seconds', max(0, (datetime.now(timezone.utc) - sent_at).total_seconds()), handler=func.__name__)
+        t1 = time.perf_counter()
+        try:
+            return await func(update, context, *args, **kwargs)
+        finally:
+            metrics.observe('handler_seconds', time.perf_counter() - t1, handler=func.__name__)
     return wrapped
 
 
@@ -90,14 +246,26 @@ def drop_edits(func):
 
 
 def timer(func):
-    '''Decorator to measure how long a function ran. Need to uncomment the logging line to see results'''
+    '''Decorator to measure how long a function ran and how it turned out. Results go into `metrics`, see /stats'''
     @functools.wraps(func)
     async def wrapped(*args, **kwargs):
-        t1 = time.monotonic() # perf_counter() ?
-        result = await func(*args, **kwargs)
-        t2 = time.monotonic()
-        # logging.info(f'Function {func.__name__!r} executed in {(t2-t1):.4f}s')
-        return result
+        t1 = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await func(*args, **kwargs)
+            outcome = 'hit' if result else 'miss'
+            return result
+        except ProviderOpen:
+            outcome = 'skipped'
+            raise
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            metrics.observe('call_seconds', time.perf_counter() - t1, function=func.__name__, outcome=outcome)
     return wrapped
 
 
@@ -107,17 +275,93 @@ def snitch(func):
     async def wrapped(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
+        except ProviderOpen:
+            return  # Skipped on purpose, nothing to report
         except Exception as e:
             trace = "".join(traceback.format_tb(sys.exc_info()[2]))
             logging.warning(f"{type(e).__name__}: {e}\n{trace}")
     return wrapped
 
 
+def cached(hit_ttl: float, miss_ttl: float):
+    '''Decorator to remember what a bypass returned for a url across all chats.
+    Found links are kept for `hit_ttl` seconds, misses for `miss_ttl` seconds.
+    Exceptions, timeouts and open breakers included, pass straight through and are not cached, so the next call tries again'''
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapped(url, *args, **kwargs):
+            key = (func.__name__, normalize_url(url))
+            result = bypass_cache.get(key, NOT_CACHED)  # Cached misses are None, so need a different sentinel
+            if result is NOT_CACHED and shared_cache and (entry := await shared_cache.get(key)):
+                result, expires = entry  # Another worker found it
+                bypass_cache.set(key, result, expires - time.time())
+            if result is not NOT_CACHED:
+                metrics.count('bypass_cache_total', provider=func.__name__, result='hit')
+                return result
+            metrics.count('bypass_cache_total', provider=func.__name__, result='miss')
+            result = await func(url, *args, **kwargs)
+            bypass_cache.set(key, result, hit_ttl if result else miss_ttl)
+            if shared_cache:
+                await shared_cache.set(key, result, hit_ttl if result else miss_ttl)
+            return result
+        return wrapped
+    return decorator
+
+
+def circuit_breaker(func):
+    '''Decorator to stop calling a bypass that keeps failing or timing out, and to try it again once in a while'''
+    breaker = breakers.setdefault(func.__name__, CircuitBreaker(func.__name__))
+    @functools.wraps(func)
+    async def wrapped(*args, **kwargs):
+        if not breaker.allow():
+            raise ProviderOpen(func.__name__)
+        outcome = breaker.release
+        try:
+            result = await func(*args, **kwargs)
+            outcome = breaker.success
+            return result
+        except Overloaded:
+            raise  # Shed by our own scheduler, says nothing about the bypass
+        except Exception:
+            outcome = breaker.failure
+            raise
+        finally:
+            outcome()  # Cancelled calls count as neither, but free up the half-open slot
+    return wrapped
+
+
+def adaptive_deadline(func):
+    '''Decorator to give up on a bypass once it has run well past its own usual latency.
+    Time spent waiting on the outbound scheduler doesn't count, that's our queue and not the bypass being slow'''
+    tracker = latencies[func.__name__]
+    @functools.wraps(func)
+    async def wrapped(*args, **kwargs):
+        deadline = tracker.deadline()
+        queued = QueueTime()
+        token = queue_time.set(queued)
+        try:
+            task = asyncio.ensure_future(func(*args, **kwargs))  # Takes a copy of the context, so the scheduler reports to `queued`
+        finally:
+            queue_time.reset(token)
+        t1 = time.monotonic()
+        try:
+            while not task.done():
+                if (remaining := deadline + queued.seconds() - (time.monotonic() - t1)) <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait((task,), timeout=remaining)
+            return task.result()
+        finally:
+            task.cancel()  # Does nothing if it finished
+            tracker.add(min(time.monotonic() - t1 - queued.seconds(), deadline))
+    return wrapped
+
+
 def send_typing_action(func):
     '''Decorator to send typing action while processing func command'''
     @functools.wraps(func)
     async def wrapped(update, context, *args, **kwargs):
-        await context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
+        chat_id = update.effective_message.chat_id
+        outbox.typing(chat_id, lambda: context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING))
         return await func(update, context, *args, **kwargs)
     return wrapped
 
@@ -144,32 +388,54 @@ async def chat_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @drop_edits
 @send_typing_action
 async def library_versions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    '''Show installed library versions and the latest available versions online'''
-
-    installed_result = subprocess.run(['pip', 'list', '--format=columns'], capture_output=True, text=True)
-    outdated_result = subprocess.run(['pip', 'list', '--outdated', '--format=columns'], capture_output=True, text=True)
-
-    installed_libraries = installed_result.stdout.splitlines()
-    outdated_libraries = outdated_result.stdout.splitlines()
-
-    outdated_dict = {line.split()[0]: line.split()[2] for line in outdated_libraries[2:]}
-
-    response = [f'Python {sys.version}', '', installed_libraries[0]]  # Headers
-    for line in installed_libraries[2:]:
-        lib_name = line.split()[0]
-        if lib_name in outdated_dict:
-            response.append(f"{line} (latest: {outdated_dict[lib_name]})")
+    '''Show installed library versions and the latest available versions online. Answered from what refresh_metadata_task() last found'''
+    installed_libraries = sorted(metadata.installed.items(), key=lambda item: item[0].lower())
+    width = max([len(name) for name, _ in installed_libraries] + [len('Package')])
+
+    response = [f'Python {sys.version}', '', f'{"Package":<{width}} Version', f'{"-" * width} -------']  # Headers
+    for name, installed_version in installed_libraries:
+        line = f'{name:<{width}} {installed_version}'
+        if latest := metadata.outdated.get(package_key(name)):
+            response.append(f"{line} (latest: {latest})")
         else:
             response.append(line)
 
     further_instructions = ''
-    if outdated_dict:
-        further_instructions = "To update all outdated libraries, run:\n<code>pip list --outdated | awk 'NR>2 {print $1}' | xargs -n1 pip install -U</code>"
+    if metadata.outdated:
+        further_instructions = "To update all outdated libraries, run:\n<code>pip list --outdated | awk 'NR>2 {print $1}' | xargs -n1 pip install -U</code>\n"
 
     text = html.escape("\n".join(response))
 
     if text:
-        await say(f'<pre>{text}</pre>{further_instructions}', update, context)
+        await say(f'<pre>{text}</pre>{further_instructions}<i>Installed list {checked(metadata.installed_checked)}, updates {checked(metadata.outdated_checked)}</i>', update, context)
+
+
+@log
+@drop_edits
+@send_typing_action
+async def breaker_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Show the circuit breaker state and health of every bypass that has one'''
+    text = '\n'.join(f'<b>{html.escape(name)}</b>: {breaker.describe()}' for name, breaker in sorted(breakers.items()))
+    await say(text or 'No bypasses have run yet', update, context)
+
+
+@log
+@drop_edits
+@send_typing_action
+async def migrate_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Upgrade every stored chat to the current schema now, instead of as each one is next seen'''
+    if not isinstance(context.application.persistence, SQLitePersistence):
+        return await say('Only works with the SQLite persistence', update, context)
+    upgraded, total = await context.application.persistence.migrate_all()
+    await say(f'Upgraded {upgraded} of {total} stored chats to schema version {CHAT_SCHEMA_VERSION}', update, context)
+
+
+@log
+@drop_edits
+@send_typing_action
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Show latency histograms and counters collected since startup'''
+    await say(f'<pre>{html.escape(metrics.summary()[:4000])}</pre>', update, context)  # Telegram caps messages at 4096 characters
 
 
 # internal bot helper stuff
@@ -177,16 +443,21 @@ async def say(text: str, update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     '''Send text to channel'''
     if text:
         logging.info(f'bot said:\n{text}')
-        sent_message = await context.bot.send_message(chat_id=update.effective_message.chat_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True, disable_notification=True)
+        chat_id = update.effective_message.chat_id
+        sent_message = await outbox.submit(chat_id, lambda: context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True, disable_notification=True))
+        outbox.typing_stopped(chat_id)
         return sent_message.message_id
 
 
 async def edit(text: str, message_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
-    '''Edit message `message_id` to say `text`. Delete entirely if `text` is blank'''
+    '''Edit message `message_id` to say `text`. Delete entirely if `text` is blank.
+    Edits to the same message that are still waiting to go out get merged, and only the latest text is sent'''
     logging.info(f'bot edited {message_id} to:\n{text}')
     if text:
+        chat_id = update.effective_message.chat_id
         try:
-            edited_message = await context.bot.edit_message_text(chat_id=update.effective_message.chat_id, message_id=message_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            edited_message = await outbox.submit(chat_id, lambda: context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview=True),
+                                                 key=('edit', message_id))
             return edited_message.message_id
         except BadRequest:
             logging.info('no change')
@@ -196,105 +467,962 @@ async def edit(text: str, message_id: int, update: Update, context: ContextTypes
 
 async def delete(message_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Remove message `message_id`'''
-    await context.bot.delete_message(chat_id=update.effective_message.chat_id, message_id=message_id)
+    chat_id = update.effective_message.chat_id
+    await outbox.submit(chat_id, lambda: context.bot.delete_message(chat_id=chat_id, message_id=message_id), key=('delete', message_id))
     logging.info(f'bot deleted message {message_id}')
     response_record_remove(message_id, context)
 
 
-def response_record_add(incoming_id: int, response_id: int, incoming_text: str, context: ContextTypes.DEFAULT_TYPE) -> None:
-    '''Track `message_id` of message that triggered the bot and `message_id` of the bot's response'''
-    if response_id:
-        response_record = context.chat_data.get('response record', {})
-        response_record[incoming_id] = response_id
-        if len(response_record) > 10:
-            response_record.pop(next(iter(response_record)))  # Pop and throw away old one
+def digest(text: str) -> bytes:
+    '''Short stable fingerprint of `text`. Enough to tell whether a message changed without keeping the message'''
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
 
-        response_text_record = context.chat_data.get('response text record', {})
-        response_text_record[incoming_id] = incoming_text
-        if len(response_text_record) > 10:
-            response_text_record.pop(next(iter(response_text_record)))
+def urls_digest(urls: list[str]) -> bytes:
+    '''Fingerprint of the urls in a message, in order. Spelling differences normalize_url() irons out don't count'''
+    return digest('\n'.join(map(normalize_url, urls)))
 
-        context.chat_data['response record'] = response_record
-        context.chat_data['response text record'] = response_text_record
+
+class ResponseRecord:
+    '''Which bot message answered which incoming message, for one chat.
+    Only a view. The data itself lives in chat_data as plain containers so it pickles small and without this class:
+    incoming id -> (response id, digest of incoming text, time, urls_digest() of its urls, digest of the reply) oldest first,
+    and response id -> incoming id to find the way back. The last two are None where they weren't known'''
+    def __init__(self, chat_data: dict):
+        self.forward, self.reverse = chat_data.setdefault('response record', (OrderedDict(), {}))
+
+    def __contains__(self, incoming_id: int) -> bool:
+        return incoming_id in self.forward
+
+    def __len__(self) -> int:
+        return len(self.forward)
+
+    def response_id(self, incoming_id: int) -> int | None:
+        entry = self.forward.get(incoming_id)
+        return entry[0] if entry else None
+
+    def text_digest(self, incoming_id: int) -> bytes | None:
+        entry = self.forward.get(incoming_id)
+        return entry[1] if entry else None
+
+    def urls_digest(self, incoming_id: int) -> bytes | None:
+        entry = self.forward.get(incoming_id)
+        return entry[3] if entry else None
+
+    def reply_digest(self, incoming_id: int) -> bytes | None:
+        entry = self.forward.get(incoming_id)
+        return entry[4] if entry else None
+
+    def add(self, incoming_id: int, response_id: int, incoming_text: str, urls: list[str] | None = None, reply: str | None = None) -> None:
+        '''Remember a response. Re-adding an incoming id replaces its entry and makes it the newest'''
+        self.discard_incoming(incoming_id)
+        self.forward[incoming_id] = (response_id, digest(incoming_text), time.time(),
+                                     None if urls is None else urls_digest(urls), None if reply is None else digest(reply))
+        self.reverse[response_id] = incoming_id
+        self.prune()
+
+    def discard_incoming(self, incoming_id: int) -> None:
+        if (entry := self.forward.pop(incoming_id, None)) is not None:
+            self.reverse.pop(entry[0], None)
+
+    def discard_response(self, response_id: int) -> None:
+        if (incoming_id := self.reverse.pop(response_id, None)) is not None:
+            self.forward.pop(incoming_id, None)
+
+    def prune(self) -> None:
+        '''Drop the oldest entries until the record fits RESPONSE_WINDOW and nothing is past RESPONSE_MAX_AGE'''
+        too_old = time.time() - RESPONSE_MAX_AGE
+        while self.forward and (len(self.forward) > RESPONSE_WINDOW or next(iter(self.forward.values()))[2] < too_old):
+            _, (response_id, *_) = self.forward.popitem(last=False)
+            self.reverse.pop(response_id, None)
+
+
+def response_record_add(incoming_id: int, response_id: int, incoming_text: str, context: ContextTypes.DEFAULT_TYPE,
+                        urls: list[str] | None = None, reply: str | None = None) -> None:
+    '''Track `message_id` of message that triggered the bot and `message_id` of the bot's response.
+    With the `urls` it was about and the `reply` text, an edit to the message can tell whether there's anything to redo'''
+    if response_id:
+        ResponseRecord(context.chat_data).add(incoming_id, response_id, incoming_text, urls, reply)
 
 
 def response_record_remove(message_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Remove deleted `message_id` from record. Does nothing if `message_id` is not in record'''
-    response_record = context.chat_data.get('response record', {})
-    response_text_record = context.chat_data.get('response text record', {})
-    incoming_id = next((incoming_id for incoming_id, response_id in response_record.items() if response_id == message_id), None)
-    response_record.pop(incoming_id, None)  # Remove from the record
-    response_text_record.pop(incoming_id, None)
-    context.chat_data['response record'] = response_record
-    context.chat_data['response text record'] = response_text_record
-
-
-def get_url(text: str) -> str:
-    extractor = URLExtract()
-    extractor.update_when_older(7)  # Gets up-to-date list of TLDs from iana.org every 7 days
-    if text and (urls := extractor.find_urls(text, check_dns=True)):
-        return urls[0]
-    else:
+    ResponseRecord(context.chat_data).discard_response(message_id)
+
+
+class TTLCache:
+    '''Bounded LRU dict where every entry expires after its own ttl'''
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # key -> (expires at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None or entry[0] < time.time():
+            self.data.pop(key, None)
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float) -> None:
+        self.data[key] = (time.time() + ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)  # Evict least recently used
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def save(self, path: str) -> None:
+        '''Pickle unexpired entries to `path`. Written to a temp file first so a crash can't leave half a file'''
+        now = time.time()
+        data = OrderedDict((key, entry) for key, entry in self.data.items() if entry[0] >= now)
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(f'{path}.tmp', path)
+
+    def load(self, path: str) -> None:
+        '''Replace contents with what was saved to `path`. Does nothing if there is no usable file'''
+        try:
+            with open(path, 'rb') as f:
+                self.data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logging.info(f'Not loading {path}: {e}')
+
+
+class LatencyTracker:
+    '''Rolling window of how long something took'''
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float | None:
+        '''The `p`th percentile (0-100) of recent samples. None until there are enough of them to mean anything'''
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def deadline(self) -> float:
+        '''Twice the p95, kept between MIN_DEADLINE and MAX_DEADLINE'''
+        if (p95 := self.percentile(95)) is None:
+            return DEFAULT_DEADLINE
+        return min(MAX_DEADLINE, max(MIN_DEADLINE, 2 * p95))
+
+
+class Histogram:
+    '''Counts of observations that fell at or under each bucket bound, Prometheus style'''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[next((i for i, bound in enumerate(self.BUCKETS) if value <= bound), len(self.BUCKETS))] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, p: float) -> float:
+        '''Upper bound of the bucket the `p`th percentile landed in'''
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    '''In-process counters and histograms. Shown by /stats and optionally served to Prometheus'''
+    def __init__(self):
+        self.counters: defaultdict[tuple, float] = defaultdict(float)  # (name, labels) -> total
+        self.gauges: dict[tuple, Callable[[], float]] = {}  # (name, labels) -> function that reads the current value
+        self.histograms: defaultdict[tuple, Histogram] = defaultdict(Histogram)  # (name, labels) -> Histogram
+        self.hosts: set[str] = set()  # Hosts that got their own label, see host_label()
+        self.started = time.time()
+
+    def count(self, name: str, amount: float = 1, **labels) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def gauge(self, name: str, read: Callable[[], float], **labels) -> None:
+        self.gauges[(name, tuple(sorted(labels.items())))] = read
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.histograms[(name, tuple(sorted(labels.items())))].observe(value)
+
+    def host_label(self, host: str) -> str:
+        '''`host` as a label value. Every origin site a url points at is a host, so past METRICS_MAX_HOSTS of them the rest share one 'other' series'''
+        if host in self.hosts or len(self.hosts) < METRICS_MAX_HOSTS:
+            self.hosts.add(host)
+            return host
+        return 'other'
+
+    def summary(self) -> str:
+        '''Human readable dump for /stats. Gauges first since they're about right now. Counters with lots of series show the biggest ones'''
+        def label_text(name: str, labels: tuple) -> str:
+            return ' '.join((name, *(value for _, value in labels)))
+
+        lines = [f'Up {timedelta(seconds=int(time.time() - self.started))}']
+        for (name, labels), read in sorted(self.gauges.items()):
+            lines.append(f'{label_text(name, labels)}: {read():g}')
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            lines.append(f'{label_text(name, labels)}: n={histogram.count} p50<={histogram.percentile(50)}s p99<={histogram.percentile(99)}s')
+        for name in sorted({name for name, _ in self.counters}):
+            series = sorted(((labels, total) for (series_name, labels), total in self.counters.items() if series_name == name), key=lambda item: -item[1])
+            for labels, total in sorted(series[:SUMMARY_SERIES]):
+                lines.append(f'{label_text(name, labels)}: {total:g}')
+            if rest := series[SUMMARY_SERIES:]:
+                lines.append(f'{name} ({len(rest)} more): {sum(total for _, total in rest):g}')
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        '''Everything in the Prometheus text exposition format'''
+        def label_text(labels: tuple, **extra) -> str:
+            pairs = [*labels, *extra.items()]
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f'# TYPE outlinebot_{name} {kind}')
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f'outlinebot_{name}{label_text(labels)} {value() if callable(value) else value:g}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE outlinebot_{name} histogram')
+            for (series_name, labels), histogram in sorted(self.histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*Histogram.BUCKETS, '+Inf'), histogram.counts):
+                    cumulative += count
+                    lines.append(f'outlinebot_{name}_bucket{label_text(labels, le=bound)} {cumulative}')
+                lines.append(f'outlinebot_{name}_sum{label_text(labels)} {histogram.sum:g}')
+                lines.append(f'outlinebot_{name}_count{label_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class CountingSession(httpcloak.Session):
+    '''httpcloak session that counts outbound requests per host and sends them through the outbound scheduler.
+    Requests are shielded because httpcloak sets the result on its future without checking whether it was cancelled,
+    which happens all the time here with deadlines and hedging. The abandoned request finishes in the background instead,
+    and keeps its scheduler slot until it does'''
+    async def get_async(self, url: str, *args, **kwargs) -> httpcloak.Response:
+        return await self.scheduled('GET', url, lambda: super(CountingSession, self).get_async(url, *args, **kwargs))
+
+    async def request_async(self, method: str, url: str, *args, **kwargs) -> httpcloak.Response:
+        return await self.scheduled(method, url, lambda: super(CountingSession, self).request_async(method, url, *args, **kwargs))
+
+    async def scheduled(self, method: str, url: str, send: Callable[[], Awaitable[httpcloak.Response]]) -> httpcloak.Response:
+        host = urlsplit(url).hostname or ''
+        await outbound.acquire(host)
+        metrics.count('outbound_requests_total', host=metrics.host_label(host), method=method)
+        request = asyncio.ensure_future(send())
+        request.add_done_callback(lambda _: outbound.release(host))
+        return await asyncio.shield(request)
+
+
+class QueueTime:
+    '''How long one bypass call has spent waiting for the outbound scheduler. Overlapping waits count once'''
+    def __init__(self):
+        self.total = 0.0
+        self.waiting = 0
+        self.since = 0.0
+
+    def start(self) -> None:
+        if not self.waiting:
+            self.since = time.monotonic()
+        self.waiting += 1
+
+    def stop(self) -> None:
+        self.waiting -= 1
+        if not self.waiting:
+            self.total += time.monotonic() - self.since
+
+    def seconds(self) -> float:
+        return self.total + (time.monotonic() - self.since if self.waiting else 0)
+
+
+class OutboundScheduler:
+    '''Limits bypass requests in flight, overall and per host. Requests over the limits wait their turn,
+    highest priority first and oldest first within a priority. Priority comes from the lookup that made the request'''
+    def __init__(self, limit: int, per_host: int, shed_after: int):
+        self.limit = limit
+        self.per_host = per_host
+        self.shed_after = shed_after
+        self.in_flight = 0
+        self.hosts = Counter()  # host -> requests in flight
+        self.queued = Counter()  # host -> requests waiting
+        self.waiting = []  # Heap of (priority, order, host, future)
+        self.order = itertools.count()
+
+    def has_room(self, host: str) -> bool:
+        return self.in_flight < self.limit and self.hosts[host] < self.per_host
+
+    def take(self, host: str) -> None:
+        self.in_flight += 1
+        self.hosts[host] += 1
+
+    async def acquire(self, host: str) -> None:
+        '''Wait for a slot for `host`. Raises Overloaded instead for passive lookups when too much is waiting already'''
+        if self.has_room(host):
+            return self.take(host)
+
+        priority = lookup.priority if (lookup := current_lookup.get()) else PRIORITY_INCOMING
+        if priority > PRIORITY_COMMAND and self.queued[host] >= self.shed_after:
+            metrics.count('outbound_shed_total', host=metrics.host_label(host))
+            raise Overloaded(host)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.order), host, future))
+        self.queued[host] += 1
+        if queued := queue_time.get():
+            queued.start()
+        t1 = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(host)  # Got the slot just as it gave up. Pass it on
+            raise
+        finally:
+            future.cancel()  # So wake() skips it if it's still in the heap
+            self.queued[host] -= 1
+            if not self.queued[host]:
+                del self.queued[host]  # Every origin site gets a key. Only keep the busy ones
+            if queued:
+                queued.stop()
+            metrics.observe('outbound_queue_seconds', time.monotonic() - t1, priority='command' if priority == PRIORITY_COMMAND else 'incoming')
+
+    def release(self, host: str) -> None:
+        self.in_flight -= 1
+        self.hosts[host] -= 1
+        if not self.hosts[host]:
+            del self.hosts[host]
+        self.wake()
+
+    def wake(self) -> None:
+        '''Hand free slots to waiting requests. Ones whose host is still full stay in the queue'''
+        blocked = []
+        while self.waiting and self.in_flight < self.limit:
+            waiter = heapq.heappop(self.waiting)
+            _, _, host, future = waiter
+            if future.done():
+                continue  # Gave up waiting
+            if self.hosts[host] >= self.per_host:
+                blocked.append(waiter)
+                continue
+            self.take(host)
+            future.set_result(None)
+        for waiter in blocked:
+            heapq.heappush(self.waiting, waiter)
+
+
+class ChatOrderedUpdates(BaseUpdateProcessor):
+    '''Handles updates concurrently, except that updates from the same chat wait for the ones before them.
+    Keeps replies and chat_data changes in order while one slow chat no longer holds up all the others.
+    An update waits for its turn in its chat before it takes one of the max_concurrent_updates slots,
+    so a burst from one chat can't fill every slot with updates that are only waiting on each other.
+    PTB takes its own slot before do_process_update() is called, so that one is left unlimited and the real limit is self.slots'''
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.chat_tails: dict[int, asyncio.Future] = {}  # chat id -> done when the chat's latest update so far is finished
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.slots:
+                return await coroutine
+        previous = self.chat_tails.get(chat.id)
+        done = asyncio.get_running_loop().create_future()
+        self.chat_tails[chat.id] = done  # The next update from this chat waits on this one, first in first out
+        try:
+            if previous:
+                await asyncio.wait((previous,))  # Not await previous, which would cancel it if this one got cancelled
+            async with self.slots:  # Takes a slot only now
+                await coroutine
+        finally:
+            done.set_result(None)
+            if self.chat_tails.get(chat.id) is done:
+                del self.chat_tails[chat.id]  # Nobody else queued up behind it
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class TokenBucket:
+    '''Lets `rate` calls per second through on average, and up to `burst` at once after a quiet spell'''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    async def take(self) -> None:
+        while self.refill() < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        '''Let nothing through for `seconds`'''
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class SendQueue:
+    '''Every message, edit and delete the bot makes goes out through here. Each chat's go out one at a time and in order,
+    paced by a bucket for the chat and one for the whole bot so the bot stays under Telegram's flood limits instead of hitting them.
+    A call queued with the same key as one still waiting takes its place, so of several edits to one message only the latest gets sent'''
+    def __init__(self):
+        self.pending: dict[int, OrderedDict] = {}  # chat id -> {key: [call, future]}, oldest first
+        self.workers: dict[int, asyncio.Task] = {}  # chat id -> task sending its pending calls
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.everyone = TokenBucket(SEND_RATE, SEND_BURST)
+        self.typing_until: dict[int, float] = {}  # chat id -> monotonic time its typing action wears off
+
+    def depth(self) -> int:
+        return sum(map(len, self.pending.values()))
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable], key: Hashable | None = None):
+        '''Queue `call` for `chat_id` and wait for what it returns'''
+        return await asyncio.shield(self.enqueue(chat_id, call, key))  # Callers sharing a coalesced call don't cancel it for each other
+
+    def enqueue(self, chat_id: int, call: Callable[[], Awaitable], key: Hashable | None = None) -> asyncio.Future:
+        queue = self.pending.setdefault(chat_id, OrderedDict())
+        if key is not None and key in queue:
+            queue[key][0] = call
+            future = queue[key][1]
+            metrics.count('telegram_coalesced_total')
+        else:
+            future = asyncio.get_running_loop().create_future()
+            queue[object() if key is None else key] = [call, future]
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.drain(chat_id))
+        return future
+
+    async def drain(self, chat_id: int) -> None:
+        queue = self.pending[chat_id]
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(GROUP_SEND_RATE if chat_id < 0 else PRIVATE_SEND_RATE, CHAT_SEND_BURST))
+        try:
+            while queue:
+                await bucket.take()
+                await self.everyone.take()
+                _, (call, future) = queue.popitem(last=False)  # Popped only now so edits that came in while waiting still get merged
+                try:
+                    future.set_result(await self.send(chat_id, call, bucket))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            del self.workers[chat_id]
+            if not queue:
+                del self.pending[chat_id]
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable], bucket: TokenBucket):
+        for attempt in itertools.count():
+            try:
+                return await call()
+            except RetryAfter as e:
+                if attempt >= SEND_RETRIES:
+                    raise
+                wait = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logging.warning(f'Telegram asked for {wait}s of quiet in chat {chat_id}')
+                metrics.count('telegram_retry_after_total')
+                bucket.pause(wait)
+                await bucket.take()
+                await self.everyone.take()
+
+    def typing(self, chat_id: int, call: Callable[[], Awaitable]) -> None:
+        '''Send a chat action to `chat_id` without waiting for it. It goes around the queue and its buckets,
+        so it never spends the chat's message budget or holds up a reply. Skipped while the last one is still showing,
+        and while something for the chat is queued already, since that would end the action as soon as it went out'''
+        now = time.monotonic()
+        if self.typing_until.get(chat_id, 0) > now or self.pending.get(chat_id):
+            metrics.count('telegram_typing_skipped_total')
+            return
+        self.typing_until[chat_id] = now + TYPING_VALID
+        task = asyncio.create_task(call())
+        background_tasks.add(task)
+        task.add_done_callback(self.typing_sent)
+
+    @staticmethod
+    def typing_sent(task: asyncio.Task) -> None:
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.info(f'Chat action failed: {task.exception()!r}')
+
+    def typing_stopped(self, chat_id: int) -> None:
+        '''A message from the bot ends the typing action, so the next one has to be sent again'''
+        self.typing_until.pop(chat_id, None)
+
+
+class TimedRequest(HTTPXRequest):
+    '''Bot API requests that record how long each call took'''
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        t1 = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - t1, method=url.rsplit('/', 1)[-1])
+
+
+class ProviderOpen(Exception):
+    '''Raised instead of calling a bypass whose circuit breaker is open'''
+
+
+class Overloaded(ProviderOpen):
+    '''Raised instead of sending a request when the outbound scheduler is shedding passive lookups'''
+
+
+class CircuitBreaker:
+    '''Tracks the health of one bypass.
+    closed: calls go through. open: calls are skipped. half-open: one call goes through to see if it recovered'''
+    FAILURE_THRESHOLD = 5  # Failures in a row that open the breaker
+    MIN_COOLDOWN = 60  # Seconds the breaker stays open the first time
+    MAX_COOLDOWN = 3600  # Cooldown doubles every time a half-open probe fails, up to this
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.successes = 0
+        self.health = 1.0  # Moving average of the success rate
+        self.cooldown = self.MIN_COOLDOWN
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        '''Whether the next call should go through'''
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            if self.probing:
+                return False
+            self.probing = True
+        return self.state != 'open'
+
+    def success(self) -> None:
+        self.successes += 1
+        self.health = 0.9 * self.health + 0.1
+        self.consecutive_failures = 0
+        if self.state == 'half-open':
+            logging.info(f'Circuit breaker for {self.name} closed again after a good probe')
+            self.state = 'closed'
+            self.cooldown = self.MIN_COOLDOWN
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self.health = 0.9 * self.health
+        self.consecutive_failures += 1
+        if self.state == 'half-open':
+            self.cooldown = min(self.MAX_COOLDOWN, self.cooldown * 2)
+            self.open()
+        elif self.state == 'closed' and self.consecutive_failures >= self.FAILURE_THRESHOLD:
+            self.open()
+        self.probing = False
+
+    def release(self) -> None:
+        self.probing = False
+
+    def open(self) -> None:
+        logging.warning(f'Circuit breaker for {self.name} opened for {self.cooldown}s after {self.consecutive_failures} failures in a row')
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+
+    def describe(self) -> str:
+        text = f'{self.state}, health {self.health:.0%}, {self.successes} ok / {self.failures} failed'
+        if self.state == 'open':
+            text += f', retry in {max(0, self.cooldown - (time.monotonic() - self.opened_at)):.0f}s'
+        return text
+
+
+class Metadata:
+    '''What /version and /library_versions show. Kept fresh in the background by refresh_metadata_task() so the commands answer straight from memory'''
+    def __init__(self):
+        self.latest_version: str | None = None  # Contents of the VERSION file on GitHub
+        self.version_etag: str | None = None
+        self.version_checked: float | None = None  # time.time() of the last successful check, for each kind of data
+        self.installed: dict[str, str] = {}  # Package name -> installed version
+        self.installed_checked: float | None = None
+        self.outdated: dict[str, str] = {}  # package_key() -> latest version on PyPI, for installed packages that are behind
+        self.outdated_checked: float | None = None
+
+    async def refresh_version(self) -> None:
+        '''Conditional request, so most checks come back 304 with no body'''
+        r = await http_session.get_async(VERSION_URL, headers={'If-None-Match': self.version_etag} if self.version_etag else None)
+        if r.status_code == 304:
+            pass
+        elif r.ok:
+            self.latest_version = r.text.strip()
+            self.version_etag = next((value for name, value in r.headers.items() if name.lower() == 'etag'), None)
+        else:
+            return logging.warning(f'Could not check the latest version: HTTP {r.status_code}')
+        self.version_checked = time.time()
+
+    async def refresh_installed(self) -> None:
+        self.installed = await asyncio.to_thread(lambda: {dist.metadata['Name']: dist.version for dist in importlib.metadata.distributions() if dist.metadata['Name']})
+        self.installed_checked = time.time()
+
+    async def refresh_outdated(self) -> None:
+        '''Asks pip, which asks PyPI about every installed package. Takes a while, so it runs in its own process while the bot carries on'''
+        process = await asyncio.create_subprocess_exec(sys.executable, '-m', 'pip', 'list', '--outdated', '--format=json',
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await process.communicate()
+        if process.returncode:
+            return logging.warning(f'Could not check for outdated libraries: pip exited with {process.returncode}')
+        self.outdated = {package_key(package['name']): package['latest_version'] for package in json.loads(stdout)}
+        self.outdated_checked = time.time()
+
+    async def refresh(self) -> None:
+        results = await asyncio.gather(self.refresh_version(), self.refresh_installed(), self.refresh_outdated(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning(f'Metadata refresh failed: {result!r}')
+
+
+def package_key(name: str) -> str:
+    '''Package names as pip compares them, so names from pip and from importlib.metadata match up'''
+    return name.lower().replace('_', '-').replace('.', '-')
+
+
+def checked(when: float | None) -> str:
+    '''How fresh some cached data is, for showing next to it'''
+    if when is None:
+        return 'not checked yet, try again in a minute'
+    minutes = int(time.time() - when) // 60
+    if minutes < 1:
+        return 'checked just now'
+    if minutes < 120:
+        return f'checked {minutes} min ago'
+    return f'checked {minutes // 60} h ago'
+
+
+breakers: dict[str, CircuitBreaker] = {}  # Keyed by bypass name
+metadata = Metadata()
+outbound = OutboundScheduler(OUTBOUND_LIMIT, OUTBOUND_PER_HOST, OUTBOUND_SHED_AFTER)
+outbox = SendQueue()
+current_lookup: ContextVar['BypassLookup | None'] = ContextVar('current_lookup', default=None)  # Set inside each lookup, read by the scheduler
+queue_time: ContextVar[QueueTime | None] = ContextVar('queue_time', default=None)  # Set inside each adaptive_deadline call
+latencies: defaultdict[str, LatencyTracker] = defaultdict(LatencyTracker)  # Keyed by bypass name, or other request kind
+dns_cache = TTLCache(maxsize=4096)
+bypass_cache = TTLCache(maxsize=20000)  # Shared by all chats. Keyed by (bypass name, normalized url)
+BYPASS_CACHE_FILE = 'data/bypass_cache.pickle'
+PERSISTENCE_FILE = 'data/bot.sqlite'
+OLD_PERSISTENCE_FILE = 'data/bot.persist'  # Imported into PERSISTENCE_FILE the first time the bot starts without one
+SHARED_CACHE_FILE = 'data/bypass_cache.sqlite'  # Takes the place of BYPASS_CACHE_FILE when there are workers
+NOT_CACHED = object()
+metrics.gauge('bypass_cache_entries', lambda: len(bypass_cache))
+metrics.gauge('lookups_in_flight', lambda: len(lookups_in_flight))
+metrics.gauge('outbound_in_flight', lambda: outbound.in_flight)
+metrics.gauge('outbound_waiting', lambda: sum(outbound.queued.values()))
+metrics.gauge('telegram_send_queue', outbox.depth)
+
+
+async def host_resolves(host: str) -> bool:
+    '''Non blocking stand-in for URLExtract's check_dns. Answers are cached, negative ones for less time'''
+    if not host:
+        return False
+    host = host.lower()
+    if (resolves := dns_cache.get(host)) is not None:
+        return resolves
+
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(host, None), DNS_TIMEOUT)  # Runs in the default executor, off the event loop
+        resolves = True
+    except (OSError, UnicodeError, asyncio.TimeoutError) as e:
+        logging.info(f'Unable to resolve {host}: {e!r}')
+        resolves = False
+
+    dns_cache.set(host, resolves, DNS_TTL if resolves else DNS_NEGATIVE_TTL)
+    return resolves
+
+
+async def get_url(text: str) -> str:
+    '''Return the first url in `text` that points at a host that actually resolves'''
+    if not text:
         return ''
+    return await first_resolving(url_extractor.find_urls(text))
+
+
+async def first_resolving(urls: list[str]) -> str:
+    for url in urls:
+        if await host_resolves(urlsplit(url if '://' in url else f'http://{url}').hostname):
+            return url
+    return ''
+
+
+async def all_resolving(urls: list[str], limit: int | None = None) -> list[str]:
+    '''Every url that points at a host that resolves, in order, with repeats (by normalized url) left out.
+    Only the first `limit` different urls get looked up, so a message full of links can't set off a lookup for each'''
+    unique = list({normalize_url(url): url for url in reversed(urls)}.values())[::-1][:limit]  # First spelling of each url wins
+    resolves = await asyncio.gather(*(host_resolves(urlsplit(url if '://' in url else f'http://{url}').hostname) for url in unique))
+    return [url for url, ok in zip(unique, resolves) if ok]
+
+
+def entity_urls(message: Message) -> list[str]:
+    '''Urls Telegram already marked in the message, in the order they appear'''
+    return [entity.url if entity.type == MessageEntity.TEXT_LINK else text
+            for entity, text in message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK]).items()]
+
+
+async def refresh_tlds() -> None:
+    '''Get up-to-date list of TLDs from iana.org if ours is older than 7 days. Blocking, so done in a thread'''
+    try:
+        await asyncio.to_thread(url_extractor.update_when_older, 7)
+    except Exception as e:
+        logging.warning(f'Could not update TLD list: {e}')
+
+
+async def refresh_public_suffixes() -> None:
+    '''Swap in a domain extractor built from the live public suffix list. Blocking, so done in a thread.
+    Keeps the current one if the list can't be fetched'''
+    global domain_extractor
+    try:
+        extractor = TLDExtract(fallback_to_snapshot=False)  # Default cache dir, so this only downloads when tldextract's own cache is stale
+        await asyncio.to_thread(extractor, 'example.com')  # The list loads on first use
+    except Exception as e:
+        logging.warning(f'Could not update public suffix list: {e}')
+        return
+    domain_extractor = extractor
+    domain_of_host.cache_clear()
 
 
 def get_domain(url: str) -> str:
     '''Get the domain.tld of url. Ignore any subdomains. Is smart about things like .co.uk'''
-    extract_result = extract(url)
+    return domain_of_host(lenient_netloc(url).lower())  # How extract() itself finds the host. urlsplit() takes several times longer than the cached lookup after it
+
+
+@functools.lru_cache(maxsize=65536)
+def domain_of_host(host: str) -> str:
+    '''get_domain() for just a host. The same few hosts come up over and over, so results are kept'''
+    extract_result = domain_extractor(host)
     if extract_result.domain and extract_result.suffix:
         return f'{extract_result.domain}.{extract_result.suffix}'.lower()
     return 'no domain'
 
 
+def normalize_url(url: str) -> str:
+    '''Canonical form of url for use as a key. Lowercases scheme and host, drops the fragment'''
+    if '://' not in url:
+        url = f'http://{url}'
+    url_parts = urlsplit(url)
+    return url_parts._replace(scheme=url_parts.scheme.lower(), netloc=url_parts.netloc.lower(), fragment='').geturl()
+
+
+async def hedged(*attempts: Callable[[], Awaitable], delay: float):
+    '''Start the first attempt, and the next one each time `delay` seconds pass without an answer (or the last one failed).
+    First answer wins and the rest get cancelled'''
+    attempts = list(attempts)
+    pending = set()
+    error = None
+    try:
+        while attempts or pending:
+            if attempts:
+                pending.add(asyncio.ensure_future(attempts.pop(0)()))
+            done, pending = await asyncio.wait(pending, timeout=delay if attempts else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def check_variants(check: Callable[[str], Awaitable[str | None]], url: str) -> str | None:
+    '''Run `check` on url as is and with the query stripped (to maybe canonicalize url) at the same time.
+    The exact url wins if both are found'''
+    stripped = urlsplit(url)._replace(query='').geturl()
+    if stripped == url:
+        return await check(url)
+
+    results = await asyncio.gather(check(url), check(stripped), return_exceptions=True)
+    for result in results:
+        if result and not isinstance(result, BaseException):
+            return result
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+class Probe:
+    '''Checks whether pages load, once per url per lookup, for the bypasses that only need to know that much'''
+    HEAD_REFUSED = (403, 405, 501)  # Some servers won't answer HEAD but will serve a GET
+
+    def __init__(self, client: httpcloak.Session):
+        self.client = client
+        self.statuses: dict[str, asyncio.Future] = {}
+
+    async def ok(self, url: str) -> bool:
+        '''True if `url` responds without an error status'''
+        if url not in self.statuses:
+            self.statuses[url] = asyncio.ensure_future(self.status(url))
+        return 200 <= await asyncio.shield(self.statuses[url]) < 400
+
+    async def status(self, url: str) -> int:
+        '''HEAD the url, or failing that GET just its first byte. 0 if it could not be reached'''
+        try:
+            r = await self.client.head_async(url)
+            if r.status_code in self.HEAD_REFUSED:
+                r = await self.client.get_async(url, headers={'Range': 'bytes=0-0'})
+            return r.status_code
+        except ProviderOpen:
+            raise  # Shed, not unreachable. Don't let it get cached as a miss
+        except Exception as e:
+            logging.info(f'Could not reach {url}: {e!r}')
+            return 0
+
+
 def link(url: str, text: str) -> str:
     return f'<a href="{url}">{text}</a>'
 
 
+def shorten(url: str, length: int = 60) -> str:
+    '''Url without the scheme, cut down to `length` characters for use as a heading'''
+    url = url.split('://', 1)[-1]
+    return url if len(url) <= length else f'{url[:length - 1]}…'
+
+
 @timer
 @send_typing_action
-async def add_bypasses(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str) -> str:
-    '''Puts together links with various bypass strategies'''
+async def add_bypasses(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, progress: Callable[[str], Awaitable[None]] | None = None,
+                       priority: int = PRIORITY_INCOMING) -> str:
+    '''Puts together links with various bypass strategies. Chats asking about the same url at the same time share one lookup.
+    If `progress` is passed it gets called with the links found so far as they come in, spaced out per chat.
+    `priority` decides whose requests go first when the outbound scheduler is busy'''
     if not url:
         return ''
     if not url.startswith('http'):
         url = f'http://{url}'
 
-    try:
-        client_ctx = httpcloak.Session.load("data/session.json", timeout=2, ech_config_domain="cloudflare-ech.com")
-    except Exception:
-        client_ctx = httpcloak.Session(preset="chrome-latest", timeout=2, ech_config_domain="cloudflare-ech.com")
-
-    text = []
+    key = normalize_url(url)
+    if (lookup := lookups_in_flight.get(key)) is None:
+        lookup = BypassLookup(url, priority)
+        lookups_in_flight[key] = lookup
+
+        def forget(task: asyncio.Task) -> None:
+            if lookups_in_flight.get(key) is lookup:
+                del lookups_in_flight[key]
+            if not task.cancelled() and task.exception():  # Mark as retrieved even if every waiter gave up
+                logging.warning(f'Lookup for {url} failed: {task.exception()!r}')
+
+        lookup.task.add_done_callback(forget)
+    lookup.priority = min(lookup.priority, priority)  # A command joining a passive lookup speeds up the rest of it
+
+    async def follow() -> str:
+        '''The budget only limits waiting on the lookup. A progress() call already under way gets to finish,
+        otherwise a message it was sending would go out without the caller ever learning its id'''
+        give_up_at = time.monotonic() + LOOKUP_BUDGET + 1
+        shown = ''
+        while not lookup.task.done():
+            if (remaining := give_up_at - time.monotonic()) <= 0:
+                raise asyncio.TimeoutError
+            changed = lookup.changed
+            if (text := lookup.text()) and text != shown:
+                await progress_slot(update.effective_message.chat_id)
+                shown = lookup.text()  # Whatever came in while waiting for the slot goes out in the same edit
+                await progress(shown)
+                continue
+            changed_wait = asyncio.create_task(changed.wait())
+            await asyncio.wait((lookup.task, changed_wait), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            changed_wait.cancel()
+        return lookup.task.result()
 
-    bypass_names = (
-        (rick_roll, 'Experimental'),
-        (wayback, 'Wayback Machine'),
-        (archive_is, 'archive.is'),
-        (ghostarchive, 'Ghost Archive'),
-        (megalodon, 'megalodon.jp'),
-        (removepaywall, 'Remove Paywall'),
-        (printfriendly, 'Print Friendly'),
-        (lite_mode, 'Lite Mode'),
-        (twitter, 'Twitter Embed'),
-        (nitter, 'Twiiit')
-    )
+    try:
+        if progress:
+            return await follow()
+        return await asyncio.wait_for(asyncio.shield(lookup.task), LOOKUP_BUDGET + 1)  # shield() so one caller being cancelled doesn't cancel it for the rest
+    except asyncio.TimeoutError:  # Either this caller waited too long or the lookup itself ran out of time
+        logging.warning(f'Gave up waiting on bypasses for {url}')
+        return lookup.text()
+
+
+async def progress_slot(chat_id: int) -> None:
+    '''Wait until `chat_id` is due another progressive update'''
+    now = time.monotonic()
+    slot = max(now, next_progress_at.get(chat_id, 0))
+    next_progress_at[chat_id] = slot + PROGRESS_INTERVAL
+    await asyncio.sleep(slot - now)
+
+
+class BypassLookup:
+    '''One run of every bypass on a url. Links are collected as each bypass finishes'''
+    def __init__(self, url: str, priority: int = PRIORITY_INCOMING):
+        self.url = url
+        self.priority = priority
+        self.bypass_names = (
+            (rick_roll, 'Experimental'),
+            (wayback, 'Wayback Machine'),
+            (archive_is, 'archive.is'),
+            (ghostarchive, 'Ghost Archive'),
+            (megalodon, 'megalodon.jp'),
+            (removepaywall, 'Remove Paywall'),
+            (printfriendly, 'Print Friendly'),
+            (lite_mode, 'Lite Mode'),
+            (twitter, 'Twitter Embed'),
+            (nitter, 'Twiiit')
+        )
+        self.bp_urls = [None] * len(self.bypass_names)
+        self.changed = asyncio.Event()  # Swapped for a fresh one every time a link comes in
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> str:
+        current_lookup.set(self)  # This task's own context. Requests from the bypasses started below carry it to the scheduler
+        probe = Probe(http_session)
+
+        async def indexed(i: int, bypass) -> tuple[int, str | None]:
+            return i, await bypass(self.url, http_session, probe)
 
-    bypasses, bp_texts = zip(*bypass_names)
-    with client_ctx as client:
-        tasks = [bypass(url, client) for bypass in bypasses]
-        bp_urls = await asyncio.gather(*tasks)
+        try:
+            for next_done in asyncio.as_completed([indexed(i, bypass) for i, (bypass, _) in enumerate(self.bypass_names)], timeout=LOOKUP_BUDGET):
+                i, bp_url = await next_done
+                if bp_url:
+                    self.bp_urls[i] = bp_url
+                    self.changed, changed = asyncio.Event(), self.changed
+                    changed.set()
+        except asyncio.TimeoutError:  # Stragglers keep running in the background and still land in the cache for next time
+            logging.info(f'Bypass lookup for {self.url} ran over budget, going with what was found')
+        finally:
+            self.changed.set()  # Release anyone still following
 
-    for bp_url, bp_text in zip(bp_urls, bp_texts):
-        if bp_url:
-            text.append(link(bp_url, bp_text))
+        return self.text()
 
-    return '\n\n'.join(text)
+    def text(self) -> str:
+        '''Links found so far, always in the same order'''
+        return '\n\n'.join(link(bp_url, bp_text) for bp_url, (_, bp_text) in zip(self.bp_urls, self.bypass_names) if bp_url)
 
 
 # bypasses
-@timer
 @snitch
-async def rick_roll(url: str, client: httpcloak.Session) -> str | None:
+@timer
+async def rick_roll(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Rickrolls people on April 1st'''
     def is_april_fools():
         utc_now = datetime.now(timezone.utc)
@@ -306,41 +1434,52 @@ async def rick_roll(url: str, client: httpcloak.Session) -> str | None:
         return 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
 
 
-@timer
 @snitch
-async def wayback(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=86400, miss_ttl=900)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def wayback(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Returns the url of the latest snapshot if available on wayback machine'''
     async def check_archive_org(url: str) -> str | None:
         r = await client.get_async(f'http://archive.org/wayback/available?url={url}')
         return r.json().get('archived_snapshots', {}).get('closest', {}).get('url')
 
-    archive_org_url = await check_archive_org(url)
-    if not archive_org_url:
-        url = urlsplit(url)._replace(query='').geturl()  # Strip query to maybe canonicalize url
-        archive_org_url = await check_archive_org(url)
-    return archive_org_url
+    return await check_variants(check_archive_org, url)
 
 
-@timer
 @snitch
-async def archive_is(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=86400, miss_ttl=900)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def archive_is(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Returns the url for this page at archive.is if it exists'''
     # List of TLDs they have: .is .ph .md .li .vn .fo .today
-    async def check_archive_is(url: str) -> str | None:
-        r = await client.get_async(f'https://archive.is/timemap/{url}')
+    tracker = latencies['archive.is timemap']
+
+    async def check_mirror(mirror: str, url: str) -> str | None:
+        t1 = time.monotonic()
+        r = await client.get_async(f'https://{mirror}/timemap/{url}')
+        tracker.add(time.monotonic() - t1)
         if r.status_code == 200:
-            return f'https://archive.is/newest/{url}'
+            return f'https://{mirror}/newest/{url}'
+
+    async def check_archive_is(url: str) -> str | None:
+        '''Ask archive.is, and if it is slower than usual ask a mirror too'''
+        hedge_delay = tracker.percentile(90) or DEFAULT_DEADLINE / 2
+        mirror = random.choice(ARCHIVE_IS_MIRRORS)
+        return await hedged(lambda: check_mirror('archive.is', url), lambda: check_mirror(mirror, url), delay=hedge_delay)
 
-    archive_is_url = await check_archive_is(url)
-    if not archive_is_url:
-        url = urlsplit(url)._replace(query='').geturl()  # Strip query to maybe canonicalize url
-        archive_is_url = await check_archive_is(url)
-    return archive_is_url
+    return await check_variants(check_archive_is, url)
 
 
-@timer
 @snitch
-async def ghostarchive(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=86400, miss_ttl=900)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def ghostarchive(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Returns the url for this page at ghostarchive.org if it exists'''
     ghostarchive_url = f'https://ghostarchive.org/search?term={url}'
     r = await client.get_async(ghostarchive_url)
@@ -355,9 +1494,12 @@ async def ghostarchive(url: str, client: httpcloak.Session) -> str | None:
         return f'https://ghostarchive.org{path}'
 
 
-@timer
 @snitch
-async def megalodon(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=86400, miss_ttl=900)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def megalodon(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Returns the url of this page if available on megalodon.jp'''
     r = await client.get_async(f'https://megalodon.jp/pc/main?url={url}')
     r.raise_for_status()
@@ -368,29 +1510,34 @@ async def megalodon(url: str, client: httpcloak.Session) -> str | None:
     return megalodon_url
 
 
-@timer
 @snitch
-async def removepaywall(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=3600, miss_ttl=300)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def removepaywall(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Run url through removepaywall.com if original url actually returns anything'''
-    removepaywall_url = f'https://www.removepaywall.com/search?url={url}'
-    r = await client.get_async(url)
-    r.raise_for_status()
-    return removepaywall_url
+    if await probe.ok(url):
+        return f'https://www.removepaywall.com/search?url={url}'
 
 
-@timer
 @snitch
-async def printfriendly(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=3600, miss_ttl=300)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def printfriendly(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Run url through printfriendly.com if original url actually returns anything'''
-    printfriendly_url = f'https://www.printfriendly.com/print?url={url}'
-    r = await client.get_async(url)
-    r.raise_for_status()
-    return printfriendly_url
+    if await probe.ok(url):
+        return f'https://www.printfriendly.com/print?url={url}'
 
 
-@timer
 @snitch
-async def lite_mode(url: str, client: httpcloak.Session) -> str | None:
+@cached(hit_ttl=3600, miss_ttl=300)
+@timer
+@circuit_breaker
+@adaptive_deadline
+async def lite_mode(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Converts certain news sites to their lite versions'''
     domain = get_domain(url)
     url_parts = urlsplit(url)
@@ -410,15 +1557,13 @@ async def lite_mode(url: str, client: httpcloak.Session) -> str | None:
     else:
         lite_url = ''
 
-    if lite_url:
-        r = await client.get_async(lite_url)
-        if r.status_code == 200:
-            return lite_url
+    if lite_url and await probe.ok(lite_url):
+        return lite_url
 
 
-@timer
 @snitch
-async def twitter(url: str, client: httpcloak.Session) -> str | None:
+@timer
+async def twitter(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Converts twitter links to twitter embed links that load faster and allow logged out viewing'''
     if get_domain(url) in ('twitter.com', 'fxtwitter.com', 'x.com'):
         url_parts = urlsplit(url)
@@ -427,9 +1572,9 @@ async def twitter(url: str, client: httpcloak.Session) -> str | None:
             return url_parts._replace(netloc='platform.twitter.com', path='/embed/Tweet.html', query=f'id={tweet_id}').geturl()
 
 
-@timer
 @snitch
-async def nitter(url: str, client: httpcloak.Session) -> str | None:
+@timer
+async def nitter(url: str, client: httpcloak.Session, probe: Probe) -> str | None:
     '''Converts twitter links to a randomly chosen instance of nitter'''
     if get_domain(url) in ('twitter.com', 'fxtwitter.com', 'x.com'):
         return urlsplit(url)._replace(netloc='twiiit.com').geturl()
@@ -439,8 +1584,7 @@ async def nitter(url: str, client: httpcloak.Session) -> str | None:
 @log
 async def incoming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Check incoming message stream for urls and put attempted bypasses on them if they are in the list of domains that need it'''
-    response_record = context.chat_data.get('response record', {})
-    response_text_record = context.chat_data.get('response text record', {})
+    response_record = ResponseRecord(context.chat_data)
     incoming_id = update.effective_message.message_id
 
     for entity in update.effective_message.entities:
@@ -451,8 +1595,7 @@ async def incoming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         entity_url = ' '
 
     incoming_text = update.effective_message.text + ' ' + entity_url
-    old_text = response_text_record.get(incoming_id, '')
-    if incoming_text == old_text:
+    if digest(incoming_text) == response_record.text_digest(incoming_id):
         logging.info('GOT YOU! GTFO here with your broken reactions')
         return  # It's actually just a reaction on a message over one hour old. Bail out.
 
@@ -460,20 +1603,73 @@ async def incoming(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.info("Ignoring edited message because it's too old")
         return
 
-    url = get_url(incoming_text)
-    if url:
-        context.chat_data['last url'] = incoming_id, url
+    found = entity_urls(update.effective_message)
+    if not found and (update.edited_message or update.effective_message.forward_origin):
+        found = url_extractor.find_urls(incoming_text)  # Entities aren't reliably there on these, do it the slow way
 
-    active_set = context.chat_data.get('active domains', set())
-    text = await add_bypasses(update, context, url) if get_domain(url) in active_set else ''
+    if update.edited_message and urls_digest(found) == response_record.urls_digest(incoming_id):
+        logging.info('Edit left the urls alone, keeping the response as it is')
+        return  # A typo fix. Looking it all up again would only come back with the same links
 
-    if incoming_id in response_record:  # Ie, edited message has already been responded to previously
-        response_id = await edit(text, response_record[incoming_id], update, context)  # Will delete the response if the new text is empty
-    else:
-        response_id = await say(text, update, context)
+    urls = await all_resolving(found, URLS_PER_MESSAGE) if found else []
+
+    if not urls and incoming_id not in response_record:
+        return  # Plain chatter. Nothing to say and no old response to take back
+
+    if urls:
+        context.chat_data['last url'] = incoming_id, urls[0]
+
+    active_set = context.chat_data.get('active domains', set())
+    targets = [url for url in urls if get_domain(url) in active_set]
+    sections = dict.fromkeys(targets, '')  # url -> links found for it so far
+    response_id = response_record.response_id(incoming_id)  # Ie, edited message has already been responded to previously
+    shown = response_record.reply_digest(incoming_id)  # Digest of what the response says now, so a reply that comes out the same isn't sent again
+    progressed = False
+    replying = asyncio.Lock()  # Links for several urls come in at once. Only the first may send, the rest edit what it sent
+    lookups = asyncio.Semaphore(LOOKUPS_PER_MESSAGE)
+
+    def combined() -> str:
+        '''One reply covering every url. Headed by url when there is more than one'''
+        if len(sections) == 1:
+            return next(iter(sections.values()))
+        return '\n\n'.join(f'<b>{html.escape(shorten(url))}</b>\n{text}' for url, text in sections.items() if text)
+
+    async def show() -> None:
+        '''Post the first links found, then keep editing that message as more come in'''
+        nonlocal response_id, shown, progressed
+        async with replying:
+            text = combined()
+            if digest(text) == shown:
+                return
+            if response_id:
+                response_id = await edit(text, response_id, update, context) or response_id
+            else:
+                response_id = await say(text, update, context)
+            shown = digest(text)
+            progressed = True
+
+    async def lookup(url: str) -> None:
+        async def progress(partial: str) -> None:
+            sections[url] = partial
+            await show()
+
+        async with lookups:
+            sections[url] = await add_bypasses(update, context, url, progress=progress)
+
+    await asyncio.gather(*(lookup(url) for url in targets))
+
+    async with replying:
+        text = combined()
+        if digest(text) != shown:
+            if progressed:
+                await progress_slot(update.effective_message.chat_id)
+            if response_id:
+                response_id = await edit(text, response_id, update, context)  # Will delete the response if the new text is empty
+            else:
+                response_id = await say(text, update, context)
 
     if response_id:
-        response_record_add(incoming_id, response_id, incoming_text, context)
+        response_record_add(incoming_id, response_id, incoming_text, context, found, text)
 
 
 # user accessible commands
@@ -493,13 +1689,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 @drop_edits
 @send_typing_action
 async def version(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    url = 'https://raw.githubusercontent.com/Yossi/outline-tg-bot/master/VERSION'
-    with httpcloak.Session(preset="chrome-latest") as client:
-        r = await client.get_async(url)
-    if r.text.strip() != __version__:
-        await say(f'Running: {__version__}\nLatest: <a href="https://github.com/Yossi/outline-tg-bot">{r.text}</a>', update, context)
+    '''Show the running version, and the latest one if it's different. Answered from what refresh_metadata_task() last found'''
+    if metadata.latest_version and metadata.latest_version != __version__:
+        await say(f'Running: {__version__}\nLatest: <a href="https://github.com/Yossi/outline-tg-bot">{metadata.latest_version}</a>\n<i>Latest {checked(metadata.version_checked)}</i>', update, context)
     else:
-        await say(__version__, update, context)
+        await say(f'{__version__}\n<i>Latest {checked(metadata.version_checked)}</i>', update, context)
 
 
 @log
@@ -508,7 +1702,7 @@ async def version(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def translate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Run the page at url through google translate'''
     if update.effective_message.reply_to_message:
-        url = get_url(update.effective_message.reply_to_message.text)
+        url = await get_url(update.effective_message.reply_to_message.text)
     else:
         url = context.chat_data.get('last url', (0, ''))[1]
 
@@ -546,11 +1740,11 @@ async def include(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_message.reply_to_message:  # Add domain by replying to a message
         incoming_text = update.effective_message.reply_to_message.text
         incoming_id = update.effective_message.reply_to_message.message_id
-        url = get_url(incoming_text)
+        url = await get_url(incoming_text)
         domain = get_domain(url)  # Returns string 'no domain' if none found
         text = include_domain(domain)
         if url:
-            text = await add_bypasses(update, context, url)
+            text = await add_bypasses(update, context, url, priority=PRIORITY_COMMAND)
 
     elif context.args:  # Directly add domain
         responses = []
@@ -565,11 +1759,11 @@ async def include(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         domain = get_domain(url)
         text = include_domain(domain)
         if url:
-            text = await add_bypasses(update, context, url)
+            text = await add_bypasses(update, context, url, priority=PRIORITY_COMMAND)
 
     response_id = await say(text, update, context)
     if response_id and incoming_text:
-        response_record_add(incoming_id, response_id, incoming_text, context)
+        response_record_add(incoming_id, response_id, incoming_text, context, reply=text)
 
 
 @log
@@ -591,7 +1785,7 @@ async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if update.effective_message.reply_to_message:
         incoming_text = update.effective_message.reply_to_message.text
-        url = get_url(incoming_text)
+        url = await get_url(incoming_text)
         domain = get_domain(url)  # Returns string 'no domain' if none found
         text = remove_domain(domain)
 
@@ -646,11 +1840,11 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 @drop_edits
 async def export_urls(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Make settings available as a text file'''
-    await context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
     chat_id = update.effective_message.chat_id
-    bio = BytesIO('\n'.join(context.chat_data.get('active domains', set())).encode('utf8'))
-    bio.name = f'{chat_id}_urls_backup.txt'
-    await context.bot.send_document(chat_id=chat_id, document=bio)
+    outbox.typing(chat_id, lambda: context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT))
+    document = '\n'.join(context.chat_data.get('active domains', set())).encode('utf8')  # Bytes rather than a file object, so a retry after RetryAfter sends it all again
+    await outbox.submit(chat_id, lambda: context.bot.send_document(chat_id=chat_id, document=document, filename=f'{chat_id}_urls_backup.txt'))
+    outbox.typing_stopped(chat_id)
 
 
 @log
@@ -686,73 +1880,662 @@ async def import_urls(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await say(f'Added:\n{text}', update, context)
 
 
+# persistence
+class SQLitePersistence(BasePersistence):
+    '''Keeps each chat's (and user's) data in its own row of an SQLite database, so saving touches only what changed.
+    Rows are read the first time a chat is seen after startup, not all up front. The bot has no conversations or callback data to store'''
+    def __init__(self, filepath: str, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False), update_interval=update_interval)
+        self.db = sqlite3.connect(filepath, check_same_thread=False)  # Only ever used by one thread at a time, under self.lock
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS data (kind TEXT NOT NULL, id INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, id)) WITHOUT ROWID')
+        self.db.commit()
+        self.lock = asyncio.Lock()
+        self.loaded = {'chat': set(), 'user': set()}  # ids whose row has been read into the application since startup
+        self.pending: dict[tuple[str, int], bytes | None] = {}  # (kind, id) -> pickled data, or None to delete the row
+
+    def is_empty(self) -> bool:
+        return self.db.execute('SELECT 1 FROM data LIMIT 1').fetchone() is None
+
+    def _read(self, kind: str, id: int):
+        row = self.db.execute('SELECT value FROM data WHERE kind = ? AND id = ?', (kind, id)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _write(self, rows: dict) -> None:
+        with self.db:  # One transaction for the whole batch
+            self.db.executemany('DELETE FROM data WHERE kind = ? AND id = ?', [key for key, value in rows.items() if value is None])
+            self.db.executemany('INSERT OR REPLACE INTO data VALUES (?, ?, ?)', [(*key, value) for key, value in rows.items() if value is not None])
+
+    async def _stored(self, kind: str, id: int) -> dict | None:
+        '''What the database has for `id`, counting a write that is still queued'''
+        async with self.lock:
+            if (kind, id) in self.pending:
+                value = self.pending[(kind, id)]
+                return None if value is None else pickle.loads(value)
+            return await asyncio.to_thread(self._read, kind, id)
+
+    async def _refresh(self, kind: str, id: int, data: dict) -> None:
+        '''Fill `data` from the database the first time `id` is seen. Chats get upgraded to the current schema on the way in.
+        Only counts as loaded once the read is done, so a second caller for the same id doesn't go ahead with `data` still empty'''
+        if id in self.loaded[kind]:
+            return
+        stored = await self._stored(kind, id)
+        if stored:
+            data.update({key: value for key, value in stored.items() if key not in data})
+        if kind == 'chat':
+            migrate_chat_data(id, data)
+        self.loaded[kind].add(id)
+
+    async def _stage(self, kind: str, id: int, data: dict | None) -> None:
+        '''Queue a row to be written. Everything queued while a write is in progress goes out together in the next one'''
+        if kind in self.loaded and data is not None and id not in self.loaded[kind] and (stored := await self._stored(kind, id)):
+            # Never overwrite a row that was not read first. PTB hands over a copy here, so the row is merged into what gets written
+            # and the id stays unloaded: the chat's own data still gets filled in by refresh_chat_data() when it next comes up
+            data = {**stored, **data}
+        self.pending[(kind, id)] = None if data is None else pickle.dumps(data)
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        async with self.lock:
+            if self.pending:
+                rows, self.pending = self.pending, {}
+                await asyncio.to_thread(self._write, rows)
+
+    async def get_chat_data(self) -> dict:
+        return {}  # Loaded per chat in refresh_chat_data()
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        async with self.lock:
+            return await asyncio.to_thread(self._read, 'bot', 0) or {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass  # Read once at startup and only ever changed in memory
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._stage('chat', chat_id, data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._stage('user', user_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._stage('bot', 0, data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._stage('chat', chat_id, None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._stage('user', user_id, None)
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._write_pending()
+        self.db.close()
+
+    async def migrate_all(self) -> tuple[int, int]:
+        '''Upgrade every stored chat not loaded yet to the current schema, in one transaction so no worker can write in between.
+        Returns (chats upgraded, chats stored)'''
+        def upgrade() -> tuple[int, int]:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                rows = self.db.execute("SELECT id, value FROM data WHERE kind = 'chat'").fetchall()
+                upgraded = []
+                for id, value in rows:
+                    if id in self.loaded['chat']:
+                        continue  # Already upgraded in memory, and saved from there
+                    data = pickle.loads(value)
+                    if migrate_chat_data(id, data):
+                        upgraded.append(('chat', id, pickle.dumps(data)))
+                self.db.executemany('INSERT OR REPLACE INTO data VALUES (?, ?, ?)', upgraded)
+            return len(upgraded), len(rows)
+
+        async with self.lock:
+            return await asyncio.to_thread(upgrade)
+
+    async def import_pickle(self, filepath: str) -> None:
+        '''One-shot copy of everything in an old PicklePersistence file, bringing each chat up to date on the way in'''
+        old = PicklePersistence(filepath=filepath)
+        chats = await old.get_chat_data() or {}
+        for chat, data in chats.items():
+            migrate_chat_data(chat, data)
+        rows = {('chat', chat): pickle.dumps(data) for chat, data in chats.items()}
+        rows |= {('user', user): pickle.dumps(data) for user, data in (await old.get_user_data() or {}).items()}
+        rows[('bot', 0)] = pickle.dumps(await old.get_bot_data() or {})
+        async with self.lock:
+            await asyncio.to_thread(self._write, rows)
+        logging.info(f'Imported {len(chats)} chats from {filepath} into {PERSISTENCE_FILE}')
+
+
+class SharedCache:
+    '''Bypass results in an SQLite file, so a link one worker looked up is a cache hit for the others.
+    Sits behind the in-memory bypass_cache, which still answers most lookups on its own'''
+    def __init__(self, filepath: str):
+        self.db = sqlite3.connect(filepath, check_same_thread=False, timeout=5)  # Only ever used by one thread at a time, under self.lock
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL NOT NULL, value TEXT) WITHOUT ROWID')
+        self.db.commit()
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def key(key: tuple) -> str:
+        return '\t'.join(key)
+
+    async def get(self, key: tuple) -> tuple[str | None, float] | None:
+        '''(value, expiry time) if there is an unexpired entry. The value is None for a cached miss'''
+        async with self.lock:
+            row = await asyncio.to_thread(lambda: self.db.execute('SELECT value, expires FROM cache WHERE key = ? AND expires > ?', (self.key(key), time.time())).fetchone())
+        return row
+
+    async def set(self, key: tuple, value: str | None, ttl: float) -> None:
+        def write():
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (self.key(key), time.time() + ttl, value))
+        async with self.lock:
+            await asyncio.to_thread(write)
+
+    async def prune(self) -> int:
+        '''Delete expired entries. Returns how many there were'''
+        def delete():
+            with self.db:
+                return self.db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),)).rowcount
+        async with self.lock:
+            return await asyncio.to_thread(delete)
+
+
+# workers
+def worker_socket(index: int) -> str:
+    return os.path.join(os.environ['BOT_WORKER_SOCKETS'], f'worker-{index}.sock')
+
+
+class WorkerLink:
+    '''The supervisor's end of one worker process. Starts it, restarts it if it dies,
+    and passes it updates over its unix socket one at a time so they arrive in order'''
+    def __init__(self, index: int):
+        self.index = index
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue()  # Update JSON waiting to be delivered
+        self.process: asyncio.subprocess.Process | None = None
+        self.stopping = False
+        self.tasks = []
+
+    async def start(self) -> None:
+        await self.spawn()
+        self.tasks = [asyncio.create_task(self.deliver()), asyncio.create_task(self.watch())]
+
+    async def spawn(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--worker', str(self.index),
+                                                            start_new_session=True)  # So a Ctrl+C reaches only the supervisor, which then stops workers in order
+        logging.info(f'Started worker {self.index} as pid {self.process.pid}')
+
+    async def watch(self) -> None:
+        while True:
+            code = await self.process.wait()
+            if self.stopping:
+                return
+            logging.warning(f'Worker {self.index} exited with {code}, restarting it')
+            await asyncio.sleep(1)
+            await self.spawn()
+
+    async def deliver(self) -> None:
+        reader = writer = None
+        while True:
+            body = await self.queue.get()
+            request = (f'POST /update HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: {os.environ["BOT_WORKER_SECRET"]}\r\n'
+                       f'Content-Length: {len(body)}\r\n\r\n').encode() + body
+            while True:
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.open_unix_connection(worker_socket(self.index))
+                    writer.write(request)
+                    await writer.drain()
+                    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+                    length = next((int(line.split(':', 1)[1]) for line in head.split('\r\n') if line.lower().startswith('content-length:')), 0)
+                    await reader.readexactly(length)
+                    if ' 200 ' not in head.split('\r\n', 1)[0]:
+                        logging.warning(f'Worker {self.index} refused an update: {head.splitlines()[0]}')
+                    if 'connection: close' in head.lower():
+                        writer.close()
+                        writer = None
+                    break
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    writer = None  # Worker still starting up, or restarting. Keep the update and try again
+                    await asyncio.sleep(0.2)
+            self.queue.task_done()
+
+    async def stop(self) -> None:
+        '''Hand over whatever is still queued, then let the worker drain and exit'''
+        try:
+            await asyncio.wait_for(self.queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f'Worker {self.index} still had {self.queue.qsize()} updates queued at shutdown')
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        if self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+
+worker_links: list[WorkerLink] = []
+
+
+async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Supervisor's only handler. Sends the update to the worker that owns its chat'''
+    chat_id = update.effective_chat.id if update.effective_chat else 0
+    worker_links[chat_id % len(worker_links)].queue.put_nowait(json.dumps(update.to_dict()).encode())
+
+
+async def start_workers(application: Application) -> None:
+    '''post_init of the supervisor. Does the one-time startup work that mustn't run in every worker, then starts them'''
+    persistence = SQLitePersistence(PERSISTENCE_FILE)
+    if persistence.is_empty() and os.path.exists(OLD_PERSISTENCE_FILE):
+        await persistence.import_pickle(OLD_PERSISTENCE_FILE)
+    bot_data = await persistence.get_bot_data()
+    await set_bot_info(application, bot_data)
+    await persistence.update_bot_data(bot_data)  # Before any worker starts, so they all load the new hash
+    await persistence.flush()
+
+    os.environ['BOT_WORKER_SOCKETS'] = tempfile.mkdtemp(prefix='outline-bot-')
+    os.environ['BOT_WORKER_SECRET'] = secrets.token_urlsafe(32)
+    for index in range(WORKERS):
+        link = WorkerLink(index)
+        await link.start()
+        worker_links.append(link)
+
+
+async def stop_workers(application: Application) -> None:
+    '''post_stop of the supervisor. Runs once every update it received has been forwarded'''
+    await asyncio.gather(*(link.stop() for link in worker_links))
+    shutil.rmtree(os.environ['BOT_WORKER_SOCKETS'], ignore_errors=True)
+
+
+def supervise() -> None:
+    '''Run as the supervisor of WORKERS worker processes. Gets updates from Telegram the same way a lone bot would
+    and hands each one to the worker that owns its chat, so chats stay in order while the work spreads over cores'''
+    supervisor = Application.builder().token(TOKEN).request(TimedRequest()).job_queue(None).post_init(start_workers).post_stop(stop_workers).build()
+    supervisor.add_handler(TypeHandler(Update, forward))
+    if WEBHOOK_URL:
+        asyncio.run(serve_webhook(supervisor))
+    else:
+        supervisor.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
 # bot setup
 async def post_init(application: Application) -> None:
-    '''Stuff that runs once on startup'''
-    logging.info(f'bypass bot started as @{application.bot.username}')
+    '''Stuff that runs once on startup. Steps that don't depend on each other run at the same time,
+    and the ones updates don't need to wait for carry on in the background once polling has started'''
+    logging.info(f'bypass bot started as @{application.bot.username}' + (f' (worker {worker})' if worker is not None else ''))
+    t1 = time.perf_counter()
+    timings = {}
+
+    global http_session
+    http_session = CountingSession(preset="chrome-latest", timeout=MAX_DEADLINE, ech_config_domain="cloudflare-ech.com")
+
+    steps = [timed_step(timings, 'persistence', load_persistence(application))]
+    if worker is None:  # Otherwise the supervisor sets the bot info and workers share shared_cache
+        steps.append(timed_step(timings, 'bot info', set_bot_info(application, application.bot_data)))
+        steps.append(timed_step(timings, 'bypass cache', asyncio.to_thread(bypass_cache.load, BYPASS_CACHE_FILE)))
+    if METRICS_PORT:
+        steps.append(timed_step(timings, 'metrics server', start_metrics_server()))
+    await asyncio.gather(*steps)
+    logging.info(f'Startup took {time.perf_counter() - t1:.2f}s ({time.time() - metrics.started:.2f}s since launch): '
+                 + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items()))
+
+    task = asyncio.create_task(background_startup())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def timed_step(timings: dict[str, float], name: str, step: Awaitable) -> None:
+    '''Await one startup step and note how long it took in `timings`'''
+    t1 = time.perf_counter()
+    try:
+        await step
+    finally:
+        timings[name] = time.perf_counter() - t1
+
+
+async def background_startup() -> None:
+    '''Startup steps that only make things faster or fresher. Nothing waits for them'''
+    t1 = time.perf_counter()
+    timings = {}
+    await asyncio.gather(timed_step(timings, 'session warmup', warmup_session()), timed_step(timings, 'tld refresh', refresh_tlds()),
+                         timed_step(timings, 'metadata', metadata.refresh()))
+    logging.info(f'Background startup took {time.perf_counter() - t1:.2f}s: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timings.items()))
+
+
+async def load_persistence(application: Application) -> None:
+    '''Import data from older versions of the bot. Chats are brought up to date later, one by one, as they are first seen'''
+    if worker is None and isinstance(application.persistence, SQLitePersistence) and application.persistence.is_empty() and os.path.exists(OLD_PERSISTENCE_FILE):
+        await application.persistence.import_pickle(OLD_PERSISTENCE_FILE)  # Workers leave this to the supervisor
 
-    await application.bot.set_my_commands([
+
+async def start_metrics_server() -> None:
+    global metrics_server
+    port = METRICS_PORT + (worker or 0)  # One port per worker
+    metrics_server = await asyncio.start_server(serve_metrics, '127.0.0.1', port)
+    logging.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+
+
+async def set_bot_info(application: Application, bot_data: dict) -> None:
+    '''Commands and descriptions users see for the bot. Only sent when they changed since the last time, according to `bot_data`'''
+    commands = [
         ('include', 'Add recent url to active list. Other domain may be passed instead.'),
         ('list', 'Display active list.'),
         ('remove', 'Remove passed domain. Same as /list if domain not passed.'),
         ('translate', 'Translate recent url to en. Other language code(s) may be passed as well.'),
         ('delete', 'Reply to a bot message with this to delete that message.'),
         ('version', 'Show running bot version.'),
-    ])
-
-    await application.bot.set_my_description(
+    ]
+    description = (
         'This bot will try find alternate (free) places to read the paywalled links you and your friends share. '
         'It can work in a one to one chat like this one, but is intended to be used in a group chat. '
         'The bot must be given admin rights in the group chat to be able to see all messages (Telegram rule). '
         'Once added, you post a link, then you say /include and from then on the bot will act to try to get around all links from that domain when they are posted. '
     )
+    short_description = f'Paywall bypass finder bot {__version__}'
+
+    info_hash = digest(repr((application.bot.id, commands, description, short_description)))  # Bot id in there in case the token changes to another bot
+    if bot_data.get('bot info hash') == info_hash:
+        logging.info('Bot info unchanged, not sending it')
+        return
+    await asyncio.gather(
+        application.bot.set_my_commands(commands),
+        application.bot.set_my_description(description),
+        application.bot.set_my_short_description(short_description),
+    )
+    bot_data['bot info hash'] = info_hash
 
-    await application.bot.set_my_short_description(f'Paywall bypass finder bot {__version__}')
 
-    await warmup_session()
+async def warmup_session() -> None:
+    '''Warm up the shared session by making requests to popular sites to get TLS tickets'''
+    try:
+        await asyncio.gather(http_session.get_async("https://www.google.com/"), http_session.get_async("https://www.cloudflare.com/"))
+        logging.info("Session warmed")
+    except Exception as e:
+        logging.warning(f"Could not warm up session: {e}")
 
-    await migrate(application)
 
+chat_migrations: dict[int, Callable[[int, dict], None]] = {}  # schema version -> function that brings a chat's data from the version before up to it
 
-async def warmup_session() -> None:
-    '''Warm up the session by making requests to popular sites to get TLS tickets'''
-    with httpcloak.Session(preset="chrome-latest", timeout=5) as session:
-        try:
-            session.get("https://www.google.com/")
-            session.get("https://www.cloudflare.com/")
-            session.save("data/session.json")
-            logging.info("Session warmed and saved to data/session.json")
-        except Exception as e:
-            logging.warning(f"Could not warm up session: {e}")
+
+def chat_migration(version: int):
+    '''Decorator to register the upgrade that brings chat_data to schema `version`'''
+    def decorator(func):
+        chat_migrations[version] = func
+        return func
+    return decorator
+
+
+@chat_migration(1)
+def active_domains_set(chat: int, data: dict) -> None:
+    if not isinstance(data.get('active domains', set()), set):
+        logging.info(f'Migrating chat {chat} to new active domains format')
+        data['active domains'] = set(data['active domains'].keys())  # Strong assumption that the old format was a dict
+
+
+@chat_migration(2)
+def last_url_tuple(chat: int, data: dict) -> None:
+    if not isinstance(data.get('last url', (0, '')), tuple):
+        logging.info(f'Migrating chat {chat} to new last url format')
+        data['last url'] = (0, data.get('last url', ''))  # Strong assumption that the old format was just a string
 
 
-async def migrate(application: Application) -> None:
-    '''Migrate chat_data to latest format'''
-    for chat, data in application.chat_data.items():
-        if not isinstance(data.get('active domains', set()), set):
-            logging.info(f'Migrating chat {chat} to new active domains format')
-            data['active domains'] = set(data['active domains'].keys())  # Strong assumption that the old format was a dict
+@chat_migration(3)
+def indexed_response_record(chat: int, data: dict) -> None:
+    if isinstance(data.get('response record'), dict):
+        logging.info(f'Migrating chat {chat} to new response record format')
+        old_record = data.pop('response record')
+        old_text_record = data.pop('response text record', {})
+        record = ResponseRecord(data)
+        for incoming_id, response_id in old_record.items():
+            record.add(incoming_id, response_id, old_text_record.get(incoming_id, ''))
 
-        if not isinstance(data.get('last url', (0, '')), tuple):
-            logging.info(f'Migrating chat {chat} to new last url format')
-            data['last url'] = (0, data.get('last url', ''))  # Strong assumption that the old format was just a string
 
-        context = CallbackContext(application, chat)
-        context.chat_data.update(data)
+@chat_migration(4)
+def response_record_digests(chat: int, data: dict) -> None:
+    forward, _ = data.get('response record', ({}, {}))
+    for incoming_id, entry in forward.items():
+        if len(entry) == 3:
+            forward[incoming_id] = (*entry, None, None)  # Unknown, so the next edit to these looks everything up again
+
+
+CHAT_SCHEMA_VERSION = max(chat_migrations)
+
+
+def migrate_chat_data(chat: int, data: dict) -> bool:
+    '''Bring one chat's data up to CHAT_SCHEMA_VERSION in place by running the upgrades it hasn't had yet.
+    Data from before versions existed is version 0. Returns whether anything ran'''
+    version = data.get('schema version', 0)
+    if version >= CHAT_SCHEMA_VERSION:
+        return False
+    if data:  # A brand new chat has nothing to upgrade
+        for next_version in range(version + 1, CHAT_SCHEMA_VERSION + 1):
+            chat_migrations[next_version](chat, data)
+    data['schema version'] = CHAT_SCHEMA_VERSION
+    return True
 
 
 async def refresh_session_task(context: ContextTypes.DEFAULT_TYPE) -> None:
     '''Run by job_queue periodically to keep session fresh'''
     logging.info("Refreshing session identity...")
+    http_session.clear_cookies()
+    http_session.refresh()  # Drops open connections, keeps TLS tickets
     await warmup_session()
 
 
+async def refresh_metadata_task(context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Run by job_queue periodically so /version and /library_versions have something recent to show'''
+    await metadata.refresh()
+
+
+def save_bypass_cache() -> None:
+    '''Write the bypass cache to disk and report how useful it has been'''
+    try:
+        bypass_cache.save(BYPASS_CACHE_FILE)
+        logging.info(f'Saved {len(bypass_cache)} cached bypasses. hits: {bypass_cache.hits} misses: {bypass_cache.misses}')
+    except OSError as e:
+        logging.warning(f'Could not save bypass cache: {e}')
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    '''Answer any request with the current metrics. Good enough for a Prometheus scraper on localhost'''
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = metrics.prometheus().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nConnection: close\r\n'
+                     + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class WebhookServer:
+    '''Takes updates Telegram POSTs to `path` and puts them on the application's update queue. Also answers GET /health.
+    Plain asyncio like the metrics server. Connections are kept alive since Telegram reuses them'''
+    def __init__(self, application: Application, path: str, secret: str):
+        self.application = application
+        self.path = path
+        self.secret = secret.encode()
+        self.server: asyncio.Server | None = None
+        self.draining = False
+        self.idle: set[asyncio.StreamWriter] = set()  # Connections between requests, closed right away on drain
+        self.busy: set[asyncio.StreamWriter] = set()  # Connections in the middle of a request, allowed to finish on drain
+
+    async def start(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f'Listening for webhook updates on {host}:{port}{self.path}')
+
+    async def start_unix(self, path: str) -> None:
+        '''Listen on a unix socket instead. How workers get their updates from the supervisor'''
+        if os.path.exists(path):
+            os.remove(path)  # Left over from a worker that died
+        self.server = await asyncio.start_unix_server(self.handle, path)
+        logging.info(f'Listening for updates on {path}')
+
+    async def drain(self) -> None:
+        '''Stop taking connections, close idle ones and give ones mid request a little time to finish'''
+        self.draining = True
+        self.server.close()
+        for writer in self.idle:
+            writer.close()
+        deadline = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT
+        while self.busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.idle.add(writer)
+        try:
+            while not self.draining:
+                head = await reader.readuntil(b'\r\n\r\n')
+                self.idle.discard(writer)
+                self.busy.add(writer)
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = request_line.split(' ', 2)
+                headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in header_lines if line)}
+                length = int(headers.get('content-length') or 0)
+                if length > WEBHOOK_MAX_BODY:
+                    status, body = 413, b'too large'
+                    headers['connection'] = 'close'
+                else:
+                    status, body = await self.respond(method, target, headers, await reader.readexactly(length))
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and not self.draining
+                writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\nContent-Type: text/plain\r\n'
+                             f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + body)
+                await writer.drain()
+                self.busy.discard(writer)
+                if not keep_alive:
+                    break
+                self.idle.add(writer)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass  # Hung up, or not speaking HTTP
+        finally:
+            self.idle.discard(writer)
+            self.busy.discard(writer)
+            writer.close()
+
+    async def respond(self, method: str, target: str, headers: dict[str, str], body: bytes) -> tuple[int, bytes]:
+        if method == 'GET' and target == '/health':
+            return (503, b'draining') if self.draining else (200, b'ok')
+        if method != 'POST' or target != self.path:
+            return 404, b'not found'
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', '').encode(), self.secret):
+            metrics.count('webhook_requests_total', result='forbidden')
+            return 403, b'forbidden'
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning(f'Bad webhook update: {e!r}')
+            metrics.count('webhook_requests_total', result='bad')
+            return 400, b'bad update'
+        await self.application.update_queue.put(update)
+        metrics.count('webhook_requests_total', result='ok')
+        return 200, b''
+
+
+async def serve_webhook(application: Application, worker: int | None = None) -> None:
+    '''Webhook counterpart of application.run_polling(). Runs until SIGINT or SIGTERM,
+    then stops listening and handles every update it already accepted before shutting down.
+    A worker listens on its unix socket for the supervisor instead of for Telegram'''
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+
+    if worker is None:
+        server = WebhookServer(application, urlsplit(WEBHOOK_URL).path or '/', WEBHOOK_SECRET or secrets.token_urlsafe(32))
+    else:
+        server = WebhookServer(application, '/update', os.environ['BOT_WORKER_SECRET'])
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if worker is None:
+            await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        else:
+            await server.start_unix(worker_socket(worker))
+        await application.start()
+        if worker is None:
+            await application.bot.set_webhook(WEBHOOK_URL, secret_token=server.secret.decode(), allowed_updates=ALLOWED_UPDATES)
+            logging.info(f'Webhook set to {WEBHOOK_URL}')
+
+        await stop.wait()
+        logging.info('Draining webhook')
+        await server.drain()
+        await application.stop()  # Works through everything already on the update queue first
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def save_bypass_cache_task(context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Run by job_queue periodically so the bypass cache survives restarts. Workers' shared cache is on disk already and only needs expired entries cleared'''
+    if shared_cache:
+        logging.info(f'Pruned {await shared_cache.prune()} expired entries from the shared bypass cache')
+    else:
+        save_bypass_cache()
+
+
+async def post_shutdown(application: Application) -> None:
+    '''Stuff that runs once on the way out'''
+    if not shared_cache:
+        save_bypass_cache()
+    if http_session:
+        http_session.close()
+    if metrics_server:
+        metrics_server.close()
+
+
+async def refresh_tlds_task(context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''Run by job_queue periodically to keep the url extractor's TLD list and the public suffix list fresh'''
+    await refresh_tlds()
+    await refresh_public_suffixes()
+
+
 if __name__ == '__main__':
-    persistence = PicklePersistence(filepath='data/bot.persist', on_flush=False)
-    application = Application.builder().token(TOKEN).persistence(persistence).post_init(post_init).build()
+    if '--worker' in sys.argv:  # Started by supervise()
+        worker = int(sys.argv[sys.argv.index('--worker') + 1])
+        shared_cache = SharedCache(SHARED_CACHE_FILE)
+        outbound.limit = max(1, OUTBOUND_LIMIT // WORKERS)  # The limits are for the whole bot. Each worker gets its share
+        outbound.per_host = max(1, OUTBOUND_PER_HOST // WORKERS)
+        outbox.everyone = TokenBucket(SEND_RATE / WORKERS, max(1, SEND_BURST // WORKERS))  # Telegram's limit is per bot, not per process. Chats stay with one worker, so their buckets don't need splitting
+
+    persistence = SQLitePersistence(PERSISTENCE_FILE)
+    application = Application.builder().token(TOKEN).request(TimedRequest(connection_pool_size=256)).concurrent_updates(ChatOrderedUpdates(CONCURRENT_UPDATES)).persistence(persistence).post_init(post_init).post_shutdown(post_shutdown).build()
 
     job_queue = application.job_queue
     job_queue.run_repeating(refresh_session_task, interval=86400, first=86400)
+    job_queue.run_repeating(refresh_tlds_task, interval=86400, first=86400)
+    job_queue.run_repeating(save_bypass_cache_task, interval=600, first=600)
+    job_queue.run_repeating(error_digest_task, interval=ERROR_DIGEST_INTERVAL, first=ERROR_DIGEST_INTERVAL)
+    job_queue.run_repeating(refresh_metadata_task, interval=METADATA_REFRESH_INTERVAL, first=METADATA_REFRESH_INTERVAL)
 
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('version', version))
@@ -764,10 +2547,20 @@ if __name__ == '__main__':
     application.add_handler(CommandHandler('export', export_urls))
     application.add_handler(CommandHandler('data', chat_data, filters=filters.User(user_id=LIST_OF_ADMINS)))
     application.add_handler(CommandHandler('library_versions', library_versions, filters=filters.User(user_id=LIST_OF_ADMINS)))
+    application.add_handler(CommandHandler('breakers', breaker_status, filters=filters.User(user_id=LIST_OF_ADMINS)))
+    application.add_handler(CommandHandler('stats', stats, filters=filters.User(user_id=LIST_OF_ADMINS)))
+    application.add_handler(CommandHandler('migrate', migrate_chats, filters=filters.User(user_id=LIST_OF_ADMINS)))
 
     application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), incoming))
     application.add_handler(MessageHandler(filters.Document.TEXT, import_urls)) # filters.Caption(['/import']) &
 
     application.add_error_handler(error_handler)
 
-    application.run_polling()
+    if worker is not None:
+        asyncio.run(serve_webhook(application, worker))
+    elif WORKERS > 1:
+        supervise()
+    elif WEBHOOK_URL:
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)  # Also removes the webhook if an earlier run set one
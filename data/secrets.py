@@ -0,0 +1,4 @@
+TOKEN = 'bot token you got from BotFather'
+LIST_OF_ADMINS = [192444823, #fatnino
+# Add your id here. Feel free to remove mine if you want.
+]
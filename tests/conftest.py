@@ -0,0 +1,15 @@
+'''Lets the tests import bot.py without a real data/secrets.py'''
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import data.secrets  # noqa: F401
+except ImportError:
+    secrets = types.ModuleType('data.secrets')
+    secrets.TOKEN = '1000:test'
+    secrets.LIST_OF_ADMINS = [1]
+    sys.modules['data.secrets'] = secrets
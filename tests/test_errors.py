@@ -0,0 +1,67 @@
+'''Error fingerprints and error_handler(), against a Bot whose every API call is refused'''
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.error import BadRequest
+from telegram.request import BaseRequest
+
+import bot
+
+CHAT_ID = 42
+
+
+class RefusingRequest(BaseRequest):
+    '''Answers every Bot API call with a 400, the way Telegram does for a bad chat or message id'''
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> None:
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs) -> tuple[int, bytes]:
+        return 400, json.dumps({'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}).encode()
+
+
+def message_update() -> Update:
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 7,
+        'date': 0,
+        'chat': {'id': CHAT_ID, 'type': 'private', 'first_name': 'Test'},
+        'text': 'hi',
+    }}, None)
+
+
+async def raised(call) -> BadRequest:
+    try:
+        await call
+    except BadRequest as error:
+        return error
+    raise AssertionError('no BadRequest')
+
+
+def test_api_errors_from_different_calls_get_different_fingerprints(monkeypatch):
+    '''Both end in the same PTB request frames. Only the frames in bot.py tell them apart'''
+    monkeypatch.setattr(bot, 'outbox', bot.SendQueue())
+
+    async def main() -> list[BadRequest]:
+        context = SimpleNamespace(bot=Bot('123:abc', request=RefusingRequest()))
+        return [await raised(bot.say('hi', message_update(), context)),
+                await raised(bot.delete(7, message_update(), context))]
+
+    sent, deleted = asyncio.run(main())
+    assert bot.error_fingerprint(sent) != bot.error_fingerprint(deleted)
+    assert bot.error_fingerprint(sent) == bot.error_fingerprint(sent)
+
+
+def test_errors_without_an_update_are_not_recorded(monkeypatch):
+    monkeypatch.setattr(bot, 'error_reports', {})
+    context = SimpleNamespace(error=BadRequest('polling went wrong'))
+    asyncio.run(bot.error_handler(None, context))
+    assert bot.error_reports == {}
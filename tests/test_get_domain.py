@@ -0,0 +1,32 @@
+'''get_domain() has to agree with a plain tldextract extract() on the same suffix list'''
+
+import pytest
+
+import bot
+
+CASES = (
+    'https://www.nytimes.com/2024/01/01/story.html',
+    'nytimes.com/a?ref=https://google.com/x',
+    'www.wsj.com/x?mod=http://foo.bar',
+    'https://user:pw@Sub.BBC.co.uk:443/x',
+    '//cdn.example.org/x',
+    'http://[2001:db8::1]/',
+    'example.com.',
+    'HTTPS://WWW.Example.COM',
+    'localhost:8000',
+    'a.b.github.io/x#frag://z',
+)
+
+
+def plain(url: str) -> str:
+    result = bot.domain_extractor(url)
+    return f'{result.domain}.{result.suffix}'.lower() if result.domain and result.suffix else 'no domain'
+
+
+@pytest.mark.parametrize('url', CASES)
+def test_same_as_extract(url):
+    assert bot.get_domain(url) == plain(url)
+
+
+def test_url_in_the_query_is_not_the_host():
+    assert bot.get_domain('nytimes.com/a?ref=https://google.com/x') == 'nytimes.com'
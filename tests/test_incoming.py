@@ -0,0 +1,83 @@
+'''incoming() against a fake bot and a fake lookup, no network'''
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram import Update
+
+import bot
+
+CHAT_ID = 42
+
+
+class FakeBot:
+    '''Records what the bot sent. Sending a new message takes `send_delay` seconds, like a chat whose send bucket is empty'''
+    def __init__(self, send_delay: float = 0):
+        self.send_delay = send_delay
+        self.sent = []
+        self.edits = []
+        self.next_id = 1000
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.send_delay)
+        self.next_id += 1
+        self.sent.append((self.next_id, text))
+        return SimpleNamespace(message_id=self.next_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.edits.append((message_id, text))
+        return SimpleNamespace(message_id=message_id)
+
+    async def send_chat_action(self, chat_id, action):
+        return True
+
+
+class SlowLookup:
+    '''Finds one link straight away and a second one a little later'''
+    def __init__(self, url: str, priority: int):
+        self.url = url
+        self.priority = priority
+        self.found = []
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> str:
+        for name, delay in (('first', 0.01), ('second', 0.3)):
+            await asyncio.sleep(delay)
+            self.found.append(name)
+            self.changed, changed = asyncio.Event(), self.changed
+            changed.set()
+        return self.text()
+
+    def text(self) -> str:
+        return '\n'.join(self.found)
+
+
+def message_update(url: str) -> Update:
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 7,
+        'date': int(time.time()),
+        'chat': {'id': CHAT_ID, 'type': 'private', 'first_name': 'Test'},
+        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Test'},
+        'text': url,
+        'entities': [{'type': 'url', 'offset': 0, 'length': len(url)}],
+    }}, None)
+
+
+def test_progress_send_outlasting_the_budget_is_edited_not_repeated(monkeypatch):
+    '''The first reply takes longer to send than the lookup budget. It must still be the one message that gets edited'''
+    monkeypatch.setattr(bot, 'BypassLookup', SlowLookup)
+    monkeypatch.setattr(bot, 'LOOKUP_BUDGET', 0.1)
+    monkeypatch.setattr(bot, 'outbox', bot.SendQueue())
+    monkeypatch.setattr(bot, 'next_progress_at', {})
+    bot.dns_cache.set('example.com', True, 60)
+
+    fake_bot = FakeBot(send_delay=1.5)
+    context = SimpleNamespace(bot=fake_bot, chat_data={'active domains': {'example.com'}})
+    asyncio.run(bot.incoming(message_update('https://example.com/story'), context))
+
+    assert [text for _, text in fake_bot.sent] == ['first']
+    response_id = fake_bot.sent[0][0]
+    assert fake_bot.edits == [(response_id, 'first\nsecond')]
+    assert bot.ResponseRecord(context.chat_data).response_id(7) == response_id
@@ -0,0 +1,94 @@
+'''SQLitePersistence against a throwaway database'''
+
+import asyncio
+import copy
+
+import bot
+
+CHAT_ID = -100
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def stored_chat(path, chat_id: int = CHAT_ID) -> dict:
+    '''What a fresh process would load for the chat'''
+    persistence = bot.SQLitePersistence(str(path))
+    data = {}
+    await persistence.refresh_chat_data(chat_id, data)
+    await persistence.flush()
+    return data
+
+
+async def save_chat(path, data: dict, chat_id: int = CHAT_ID) -> None:
+    persistence = bot.SQLitePersistence(str(path))
+    await persistence.refresh_chat_data(chat_id, {})
+    await persistence.update_chat_data(chat_id, data)
+    await persistence.flush()
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'bot.sqlite'
+    run(save_chat(path, {'active domains': {'example.com'}}))
+    assert run(stored_chat(path))['active domains'] == {'example.com'}
+
+
+def test_old_chat_is_upgraded_on_load(tmp_path):
+    path = tmp_path / 'bot.sqlite'
+    persistence = bot.SQLitePersistence(str(path))
+    persistence._write({('chat', CHAT_ID): bot.pickle.dumps({'active domains': {'example.com': None}, 'last url': 'https://example.com/a'})})
+    persistence.db.close()
+
+    data = run(stored_chat(path))
+    assert data['active domains'] == {'example.com'}
+    assert data['last url'] == (0, 'https://example.com/a')
+    assert data['schema version'] == bot.CHAT_SCHEMA_VERSION
+
+
+def test_update_before_refresh_keeps_the_stored_row_and_the_live_data(tmp_path):
+    '''PTB can save a chat it hasn't refreshed yet, and hands over a deepcopy when it does.
+    The stored row must survive that, and the chat's live data must still get loaded afterwards'''
+    path = tmp_path / 'bot.sqlite'
+    run(save_chat(path, {'active domains': {'example.com'}}))
+
+    async def restart() -> dict:
+        persistence = bot.SQLitePersistence(str(path))
+        live = {}
+        await persistence.update_chat_data(CHAT_ID, copy.deepcopy(live))
+        await persistence.refresh_chat_data(CHAT_ID, live)
+        live['active domains'].add('example.org')
+        await persistence.update_chat_data(CHAT_ID, copy.deepcopy(live))
+        await persistence.flush()
+        return live
+
+    assert run(restart())['active domains'] == {'example.com', 'example.org'}
+    assert run(stored_chat(path))['active domains'] == {'example.com', 'example.org'}
+
+
+def test_concurrent_refreshes_both_see_the_stored_data(tmp_path):
+    '''A second refresh for the same id must not return before the data is actually there'''
+    path = tmp_path / 'bot.sqlite'
+    persistence = bot.SQLitePersistence(str(path))
+    persistence._write({('user', 7): bot.pickle.dumps({'seen': True})})
+
+    async def both() -> list[dict]:
+        first, second = {}, {}
+        await asyncio.gather(persistence.refresh_user_data(7, first), persistence.refresh_user_data(7, second))
+        await persistence.flush()
+        return [first, second]
+
+    assert run(both()) == [{'seen': True}, {'seen': True}]
+
+
+def test_drop_deletes_the_row(tmp_path):
+    path = tmp_path / 'bot.sqlite'
+    run(save_chat(path, {'active domains': {'example.com'}}))
+
+    async def drop() -> None:
+        persistence = bot.SQLitePersistence(str(path))
+        await persistence.drop_chat_data(CHAT_ID)
+        await persistence.flush()
+
+    run(drop())
+    assert run(stored_chat(path)) == {'schema version': bot.CHAT_SCHEMA_VERSION}
@@ -0,0 +1,65 @@
+'''SendQueue pacing, merging and flood handling, without Telegram'''
+
+import asyncio
+
+from telegram.error import RetryAfter
+
+import bot
+
+GROUP = -100
+
+
+def test_waiting_edits_to_one_message_are_merged():
+    async def main() -> tuple[list[str], list[str]]:
+        queue = bot.SendQueue()
+        sent = []
+
+        def edit(text: str):
+            async def call() -> str:
+                sent.append(text)
+                return text
+            return call
+
+        queue.chat_buckets[GROUP] = bot.TokenBucket(1000, 1)
+        queue.chat_buckets[GROUP].tokens = 0  # So the edits pile up behind the first token
+        results = await asyncio.gather(*(queue.submit(GROUP, edit(text), key=('edit', 1)) for text in ('a', 'ab', 'abc')))
+        return sent, results
+
+    sent, results = asyncio.run(main())
+    assert sent == ['abc']
+    assert results == ['abc'] * 3
+
+
+def test_retry_after_is_waited_out_and_retried():
+    async def main() -> list[int]:
+        queue = bot.SendQueue()
+        attempts = []
+
+        async def call() -> int:
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise RetryAfter(0)
+            return 7
+
+        assert await queue.submit(GROUP, call) == 7
+        return attempts
+
+    assert asyncio.run(main()) == [0, 1]
+
+
+def test_typing_skips_the_buckets_and_repeats():
+    async def main() -> tuple[int, float]:
+        queue = bot.SendQueue()
+        actions = []
+
+        async def action() -> None:
+            actions.append(1)
+
+        for _ in range(3):
+            queue.typing(GROUP, action)
+        await asyncio.sleep(0.01)
+        return len(actions), queue.chat_buckets.get(GROUP, bot.TokenBucket(1, bot.CHAT_SEND_BURST)).refill()
+
+    sent, tokens_left = asyncio.run(main())
+    assert sent == 1
+    assert tokens_left == bot.CHAT_SEND_BURST
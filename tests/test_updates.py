@@ -0,0 +1,60 @@
+'''ChatOrderedUpdates, driven the way Application drives it'''
+
+import asyncio
+import time
+
+from telegram import Update
+
+import bot
+
+
+def update(update_id: int, chat_id: int) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'group', 'title': 'test'},
+        'text': 'hi',
+    }}, None)
+
+
+def test_busy_chat_keeps_its_order_and_leaves_slots_for_others():
+    '''20 updates from one chat and 8 slots. A quiet chat's update must not queue up behind the busy chat'''
+    async def main() -> tuple[list[int], float]:
+        processor = bot.ChatOrderedUpdates(8)
+        handled = []
+        finished_at = {}
+
+        async def handle(update_id: int) -> None:
+            await asyncio.sleep(0.1)
+            handled.append(update_id)
+            finished_at[update_id] = time.perf_counter()
+
+        t1 = time.perf_counter()
+        busy = [asyncio.create_task(processor.process_update(update(n, -1), handle(n))) for n in range(20)]
+        await asyncio.sleep(0)
+        await processor.process_update(update(100, -2), handle(100))
+        await asyncio.gather(*busy)
+        return [n for n in handled if n != 100], finished_at[100] - t1
+
+    busy_order, quiet_took = asyncio.run(main())
+    assert busy_order == list(range(20))
+    assert quiet_took < 0.5
+
+
+def test_no_more_than_max_concurrent_updates_at_once():
+    async def main() -> int:
+        processor = bot.ChatOrderedUpdates(4)
+        running = 0
+        most = 0
+
+        async def handle() -> None:
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(update(n, -n), handle()) for n in range(1, 21)))
+        return most
+
+    assert asyncio.run(main()) == 4